@@ -15,21 +15,93 @@
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import asyncio
+import gzip
+import io
 import itertools
+import os
 import re
+import shutil
+import time
 import urllib.request
 import xml.etree.ElementTree as ElementTree
 
 import aiohttp
 import feedparser
+import numpy as np
 
 import waterbug
 
+titles_file = "animetitles.xml"
+titles_url = CONFIG.get("titles_url", "http://anidb.net/api/anime-titles.xml.gz")
+# anidb bans clients that fetch the title dump more than once a day
+titles_refresh_interval = max(CONFIG.get("titles_refresh_interval", 60*60*24), 60*60*24)
+
+class CategoryMatrix:
+    """Sparse anime x category weight matrix, used to find anime with similar categories"""
+
+    def __init__(self, categories=None):
+        self.rows = {}
+        self.columns = {}
+        self._matrix = None
+        for aid, weights in (categories or {}).items():
+            self.add(aid, weights)
+
+    def add(self, aid, weights):
+        for name in weights:
+            self.columns.setdefault(name, len(self.columns))
+        self.rows[aid] = weights
+        self._matrix = None
+
+    def _build(self):
+        aids = list(self.rows)
+        row_ids, indices, data = [], [], []
+        for row, aid in enumerate(aids):
+            for name, weight in self.rows[aid].items():
+                row_ids.append(row)
+                indices.append(self.columns[name])
+                data.append(weight)
+
+        row_ids = np.array(row_ids, dtype=np.intp)
+        indices = np.array(indices, dtype=np.intp)
+        data = np.array(data, dtype=np.float64)
+        norms = np.sqrt(np.bincount(row_ids, weights=data**2, minlength=len(aids)))
+        self._matrix = np.array(aids, dtype=np.int64), row_ids, indices, data, norms
+
+    def similar(self, aid, limit):
+        """Returns up to limit (aid, cosine similarity) pairs, most similar first"""
+        if aid not in self.rows:
+            return []
+        if self._matrix is None:
+            self._build()
+        aids, row_ids, indices, data, norms = self._matrix
+
+        query = np.zeros(len(self.columns))
+        for name, weight in self.rows[aid].items():
+            query[self.columns[name]] = weight
+        query_norm = np.linalg.norm(query)
+        if query_norm == 0:
+            return []
+
+        dots = np.bincount(row_ids, weights=data * query[indices], minlength=len(aids))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = dots / (norms * query_norm)
+        scores[(norms == 0) | (aids == aid)] = 0
+
+        limit = min(limit, len(scores))
+        if limit == 0:
+            return []
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top])]
+        return [(int(aids[i]), float(scores[i])) for i in top if scores[i] > 0]
+
+
 class Commands(waterbug.Commands):
 
     @waterbug.trigger
     def unload():
         del Commands.anidb.titles
+        del Commands.anidb.exact_titles
+        del Commands.anidb.lowered_titles
 
     @waterbug.expose
     class anidb:
@@ -38,13 +110,17 @@ class Commands(waterbug.Commands):
             global anidb
             anidb = Commands.anidb
 
-            anidb.titles = anidb.load_titles(open("animetitles.xml"))
+            with open(titles_file) as f:
+                anidb.titles, anidb.exact_titles, anidb.lowered_titles = anidb.build_index(f)
             anidb.cache = {}
             anidb.url_info = CONFIG
 
-            anidb.read_from_feed = set()
+            anidb.feed_head = None
+            anidb.read_from_feed = STORAGE.get_seen_set("read_from_feed", max_age=30*24*60*60)
 
             anidb.watchedtitles = STORAGE.get_data().setdefault("watched", {})
+            anidb.categories = STORAGE.get_data().setdefault("categories", {})
+            anidb.similarity = CategoryMatrix(anidb.categories)
 
         def load_titles(file):
             titles = {}
@@ -58,8 +134,61 @@ class Commands(waterbug.Commands):
                     if elem.attrib['{http://www.w3.org/XML/1998/namespace}lang'] not in currentanime[elem.attrib['type']]:
                         currentanime[elem.attrib['type']][elem.attrib['{http://www.w3.org/XML/1998/namespace}lang']] = []
                     currentanime[elem.attrib['type']][elem.attrib['{http://www.w3.org/XML/1998/namespace}lang']].append(elem.text)
+                if event == "end" and elem.tag == "anime":
+                    elem.clear()
             return titles
 
+        def build_index(file):
+            titles = anidb.load_titles(file)
+            exact_titles = {}
+            lowered_titles = {}
+            for aid, types in titles.items():
+                lowered_titles[aid] = [title.lower() for langs in types.values()
+                                                     for titlelist in langs.values()
+                                                     for title in titlelist]
+                for title in lowered_titles[aid]:
+                    exact_titles.setdefault(title, aid)
+            return titles, exact_titles, lowered_titles
+
+        def download_titles(data):
+            # runs in a worker thread; decompress to disk and parse from there so that
+            # the whole dump never has to be held in memory as a string
+            tmpfile = titles_file + ".tmp"
+            with gzip.GzipFile(fileobj=io.BytesIO(data)) as src, open(tmpfile, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            with open(tmpfile, "rb") as f:
+                index = anidb.build_index(f)
+            os.replace(tmpfile, titles_file)
+            return index
+
+        @waterbug.periodic(titles_refresh_interval, trigger_on_start=True)
+        @asyncio.coroutine
+        def refresh_titles():
+            try:
+                age = time.time() - os.path.getmtime(titles_file)
+            except OSError:
+                age = None
+            if age is not None and age < titles_refresh_interval:
+                return
+
+            try:
+                LOGGER.info("Fetching anidb title dump")
+                data = yield from waterbug.fetch_url(titles_url, timeout=60)
+            except (asyncio.TimeoutError, aiohttp.HttpException):
+                LOGGER.warning("Couldn't fetch anidb title dump")
+                return
+
+            try:
+                index = yield from asyncio.get_event_loop().run_in_executor(
+                    None, anidb.download_titles, data)
+            except (OSError, EOFError, ElementTree.ParseError):
+                LOGGER.exception("Couldn't parse anidb title dump, keeping the old titles")
+                return
+
+            # searches never yield, so swapping everything in one statement is atomic
+            anidb.titles, anidb.exact_titles, anidb.lowered_titles = index
+            LOGGER.info("Loaded %d titles from anidb title dump", len(anidb.titles))
+
         def fetch_anime(aid):
             if aid in anidb.cache:
                 return anidb.cache[aid]
@@ -105,19 +234,32 @@ class Commands(waterbug.Commands):
 
             anidb.cache[aid] = info
 
+            weights = {category["name"]: category["weight"] for category in info["categories"]}
+            if len(weights) > 0 and anidb.categories.get(aid) != weights:
+                anidb.categories[aid] = weights
+                anidb.similarity.add(aid, weights)
+                STORAGE.sync()
+
             return info
 
-        @waterbug.periodic(120)
+        @waterbug.periodic(120, adaptive=True, min_seconds=CONFIG.get("feed_min_interval", 60),
+                           max_seconds=CONFIG.get("feed_max_interval", 30*60))
         @asyncio.coroutine
         def update_feed():
             try:
                 LOGGER.info("Fetching anidb atom feed")
-                feed = yield from waterbug.fetch_url("http://anidb.net/feeds/files.atom")
+                feed, headers = yield from waterbug.fetch_url("http://anidb.net/feeds/files.atom",
+                                                              return_headers=True)
             except (asyncio.TimeoutError, aiohttp.HttpException):
                 LOGGER.warning("Couldn't fetch anidb atom feed")
                 return
 
-            for entry in feedparser.parse(feed)["entries"]:
+            entries = feedparser.parse(feed)["entries"]
+            head = entries[0]["id"] if len(entries) > 0 else None
+            changed = head != anidb.feed_head
+            anidb.feed_head = head
+
+            for entry in entries:
                 if entry["id"] in anidb.read_from_feed:
                     continue # already checked item
 
@@ -133,33 +275,30 @@ class Commands(waterbug.Commands):
                     if title.startswith(anidb.titles[aid]["main"]["x-jat"][0]):
                         anidb.read_from_feed.add(entry["id"])
                         for (network, channel), wanted_group in targets.items():
-                            if network in anidb.bot.servers and \
-                                    channel in anidb.bot.servers[network].channels and \
+                            # identical messages to several channels on a network are sent
+                            # as one line where the server allows it
+                            if network in BOT.servers and \
+                                    channel in BOT.servers[network].channels and \
                                     (wanted_group is None or wanted_group.lower() == group.lower()):
-                                anidb.bot.servers[network].msg(
+                                BOT.servers[network].msg(
                                     channel, "New file added: {} - {}".format(title, link))
 
+            anidb.read_from_feed.sync()
+            return waterbug.PollResult(changed, waterbug.cache_lifetime(headers))
 
         def _search(animetitle, find_exact_match=False, limit=None):
             animetitle = animetitle.lower().strip().replace("'", "`")
             keywords = animetitle.split()
             results = {}
 
-            for aid, titles in anidb.titles.items():
-                match = False
-                for langs in titles.values():
-                    for titlelist in langs.values():
-                        for title in titlelist:
-                            title = title.lower()
-                            if find_exact_match and title == animetitle:
-                                return {aid: titles}
-                            if all(keyword in title for keyword in keywords):
-                                match = True
-
-                if match:
-                    if limit is None or len(results) < limit:
-                        results[aid] = titles
-                    elif not find_exact_match:
+            if find_exact_match and animetitle in anidb.exact_titles:
+                aid = anidb.exact_titles[animetitle]
+                return {aid: anidb.titles[aid]}
+
+            for aid, titles in anidb.lowered_titles.items():
+                if any(all(keyword in title for keyword in keywords) for title in titles):
+                    results[aid] = anidb.titles[aid]
+                    if limit is not None and len(results) >= limit:
                         break
 
             return results
@@ -221,6 +360,29 @@ class Commands(waterbug.Commands):
             if len(info["similaranime"]) > 3:
                 responder("More: http://anidb.net/perl-bin/animedb.pl?show=addsimilaranime&aid={}".format(aid))
 
+        @waterbug.expose
+        @asyncio.coroutine
+        def similartags(responder, *args):
+            r = anidb._search(responder.line, True, 1)
+            if len(r) == 0:
+                responder("Anime not found")
+                return
+
+            aid, _ = next(iter(r.items()))
+            if aid not in anidb.categories:
+                yield from anidb.fetch_anime(aid)
+
+            similar = [(similar_aid, score) for similar_aid, score in anidb.similarity.similar(aid, 6)
+                       if similar_aid in anidb.titles][:3]
+            if len(similar) == 0:
+                responder("No anime with similar categories found")
+                return
+
+            for similar_aid, score in similar:
+                responder("{}% - {} - http://anidb.net/a{}".format(
+                    round(100*score, 2), anidb.format_title(anidb.titles[similar_aid]),
+                    similar_aid))
+
         @waterbug.expose
         @asyncio.coroutine
         def related(responder, *args):
@@ -109,15 +109,81 @@ class Commands(waterbug.Commands):
     @asyncio.coroutine
     def whoami(responder):
         """Displays your information such as username, hostname and access level"""
-        responder.server.who(responder.sender.username)
-        yield from responder.server.on("315")
         sender = responder.sender
+        if not responder.server.tracks_account(sender) or sender.realname is None:
+            request = yield from asyncio.wait_for(responder.server.who(sender.username), 10)
+            nick = responder.server.fold(sender.username)
+            if nick in request.accounts:
+                sender.account = request.accounts[nick]
+                sender.realname = request.realnames[nick]
         responder("You are {}!{}@{} ({}), {}, and you have access {}".format(
             sender.username, sender.ident, sender.hostname, sender.realname,
             "not logged in" if sender.account is None
                             else "logged in as {}".format(sender.account),
             sender.access))
 
+    @waterbug.expose
+    def periodic(responder):
+        """Displays the periodic jobs with their schedule, hit rate and run times"""
+        for job in responder.bot.scheduler.jobs:
+            if job.cron is not None:
+                schedule = "at '{}'".format(job.cron)
+            else:
+                schedule = "every {} s{}".format(
+                    round(job.interval),
+                    " ({}-{} s)".format(round(job.min_seconds), round(job.max_seconds))
+                        if job.adaptive else "")
+            hit_rate = job.hit_rate
+            responder("{}: {}, {}/{} polls with changes{}, {} runs ({} skipped), "
+                      "{:.2f} s mean, {:.2f} s max{}".format(
+                          job.name, schedule, job.changes, job.polls,
+                          " ({:.0%})".format(hit_rate) if hit_rate is not None else "",
+                          job.runs, job.skipped, job.mean_duration or 0, job.max_duration,
+                          ", running" if job.running else ""), msgtype='NOTICE')
+
+    @waterbug.expose(require_auth=True)
+    def more(responder):
+        """Displays the notifications that didn't fit in the last digest"""
+        page = responder.bot.digest.next_page(responder.server.name, responder.sender.account)
+        responder(page if page is not None else "No more notifications")
+
+    @waterbug.expose(require_auth=True)
+    def digest(responder, window=None):
+        """Sets how many seconds of notifications to merge into one message, or 'off'"""
+        digest = responder.bot.digest
+        key = responder.server.name, responder.sender.account
+        if window is not None:
+            if window == "off":
+                digest.set_window(*key, window=0)
+            elif window == "default":
+                digest.set_window(*key, window=None)
+            else:
+                try:
+                    digest.set_window(*key, window=max(int(window), 0))
+                except ValueError:
+                    responder("Expected a number of seconds, 'off' or 'default'")
+                    return
+
+        seconds = digest.get_window(*key)
+        if seconds > 0:
+            responder("Notifications sent within {} seconds of each other are merged".format(
+                seconds))
+        else:
+            responder("Notifications are sent one by one")
+
+    @waterbug.expose
+    def lag(responder):
+        """Displays the round-trip time to the server and the current delay between lines"""
+        server = responder.server
+        if server.current_lag() is None:
+            responder("The lag to {} hasn't been measured yet".format(server.name))
+        else:
+            responder("Lag to {}: {:.0f} ms (last {:.0f} ms, lowest {:.0f} ms), "
+                      "sending a line every {:.1f} s".format(
+                          server.name, server.current_lag() * 1000,
+                          (server.last_lag or 0) * 1000, (server.min_lag or 0) * 1000,
+                          server.write_delay()))
+
     @waterbug.expose(access=waterbug.ADMIN)
     def access(responder, user, access_name):
         # TODO: fix this ugly line
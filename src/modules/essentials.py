@@ -17,20 +17,121 @@
 import asyncio
 import builtins
 import datetime
+import heapq
 import io
 import itertools
 import os
 import re
 import subprocess
 import sys
+import time
 import traceback
 
 import dateutil.parser
 
 import waterbug
 
+# reminder id -> reminder; pending reminders survive reloads and restarts, and are all run
+# by a single job on the bot's scheduler, which is moved to the earliest due reminder
+pending_reminders = STORAGE.get_data().setdefault("reminders", {})
+# (due, reminder id) for every pending reminder; cancelled reminders are left in the heap
+# until they reach the top, and reminders whose server is disconnected are pushed again to
+# be retried after reminder_retry_delay seconds
+reminder_heap = [(reminder['due'], reminder_id)
+                 for reminder_id, reminder in pending_reminders.items()]
+heapq.heapify(reminder_heap)
+reminder_retry_delay = 60
+
 class Commands(waterbug.Commands):
 
+    @asyncio.coroutine
+    def sender_account(responder):
+        """Returns the account of the sender, or None if they aren't logged in"""
+        if not responder.server.tracks_account(responder.sender):
+            try:
+                responder.sender.account = yield from responder.server.lookup_account(
+                    responder.sender)
+            except asyncio.TimeoutError:
+                pass
+        return responder.sender.account
+
+    @asyncio.coroutine
+    def add_reminder(responder, due, message):
+        account = yield from Commands.sender_account(responder)
+        data = STORAGE.get_data()
+        reminder_id = data.get("next_reminder_id", 1)
+        data["next_reminder_id"] = reminder_id + 1
+        pending_reminders[reminder_id] = {
+            "due": due,
+            "server": responder.server.name,
+            "target": responder.target,
+            "username": responder.sender.username,
+            "account": account,
+            "message": message
+        }
+        heapq.heappush(reminder_heap, (due, reminder_id))
+        STORAGE.sync()
+        Commands.schedule_reminders()
+        return reminder_id
+
+    def schedule_reminders():
+        job = Commands.run_due_reminders._period
+        if job.scheduler is None:
+            # the job runs as soon as the module has been loaded
+            return
+
+        while len(reminder_heap) > 0 and reminder_heap[0][1] not in pending_reminders:
+            heapq.heappop(reminder_heap)
+
+        # the job runs at least once an hour so that wall clock changes are noticed
+        delay = job.interval
+        if len(reminder_heap) > 0:
+            delay = min(max(reminder_heap[0][0] - time.time(), 0), delay)
+        job.scheduler.reschedule(job, delay)
+
+    @waterbug.periodic(60*60, trigger_on_start=True)
+    def run_due_reminders():
+        now = time.time()
+        changed = False
+        while len(reminder_heap) > 0 and reminder_heap[0][0] <= now:
+            _due, reminder_id = heapq.heappop(reminder_heap)
+            reminder = pending_reminders.get(reminder_id)
+            if reminder is None:
+                continue
+
+            if reminder['server'] not in BOT.config['servers']:
+                LOGGER.warning("Dropping reminder %s for %s, which is no longer configured",
+                               reminder_id, reminder['server'])
+            else:
+                server = BOT.servers.get(reminder['server'])
+                if server is None or not server.welcomed:
+                    # try again once the connection is back
+                    heapq.heappush(reminder_heap, (now + reminder_retry_delay, reminder_id))
+                    continue
+
+                message = reminder['message']
+                if reminder['target'] != reminder['username']:
+                    message = reminder['username'] + ": " + message
+                server.msg(reminder['target'], message)
+
+            del pending_reminders[reminder_id]
+            changed = True
+
+        if changed:
+            STORAGE.sync()
+        Commands.schedule_reminders()
+
+    @asyncio.coroutine
+    def owns_reminder(responder, reminder):
+        if reminder['server'] != responder.server.name:
+            return False
+        if reminder.get('account') is not None:
+            account = yield from Commands.sender_account(responder)
+            return account == reminder['account']
+        # reminders set without being logged in belong to the nick
+        return responder.server.fold(reminder['username']) == \
+            responder.server.fold(responder.sender.username)
+
     @waterbug.expose
     def echo(responder, *args):
         """Echoes back the written line"""
@@ -74,21 +175,22 @@ class Commands(waterbug.Commands):
         try:
             line = responder.line.split("!", 1)
             if len(line) == 2:
-                time, message = line
+                when, message = line
             else:
-                time, message = line[0], "Alert!"
-            time, message = time.strip(), message.strip()
+                when, message = line[0], "Alert!"
+            when, message = when.strip(), message.strip()
 
-            date = dateutil.parser.parse(time)
+            date = dateutil.parser.parse(when)
             now = datetime.datetime.now()
             if date <= now:
                 responder("The given date is in the past")
-            else:
-                responder("Will run at {}".format(date.isoformat()))
-                yield from asyncio.sleep((date - now).total_seconds())
-                responder(message)
+                return
         except Exception:
             responder("Invalid date format")
+            return
+
+        reminder_id = yield from Commands.add_reminder(responder, date.timestamp(), message)
+        responder("Will run at {} (reminder {})".format(date.isoformat(), reminder_id))
 
     @waterbug.expose
     @asyncio.coroutine
@@ -96,25 +198,68 @@ class Commands(waterbug.Commands):
         try:
             line = responder.line.split("!", 1)
             if len(line) == 2:
-                time, message = line
+                when, message = line
             else:
-                time, message = line[0], "Alert!"
-            time, message = time.strip(), message.strip()
+                when, message = line[0], "Alert!"
+            when, message = when.strip(), message.strip()
 
             times = {"h": 0, "m": 0, "s": 0}
-            tokens = re.findall(r'(\d+|[hms])', time)
+            tokens = re.findall(r'(\d+|[hms])', when)
             for digit, unit in itertools.zip_longest(tokens[0::2], tokens[1::2]):
                 digit = int(digit)
                 assert unit in 'hms'
                 times[unit] = digit
 
             seconds = times['h'] * 60 * 60 + times['m'] * 60 + times['s']
-            responder("Will run at {}".format((datetime.datetime.now() +
-                                               datetime.timedelta(seconds=seconds)).isoformat()))
-            yield from asyncio.sleep(seconds)
-            responder(message)
         except Exception:
             responder("Invalid duration format")
+            return
+
+        reminder_id = yield from Commands.add_reminder(responder, time.time() + seconds, message)
+        responder("Will run at {} (reminder {})".format(
+            (datetime.datetime.now() + datetime.timedelta(seconds=seconds)).isoformat(),
+            reminder_id))
+
+    @waterbug.expose
+    class reminders:
+
+        @waterbug.expose
+        @asyncio.coroutine
+        def _default(responder, *args):
+            """Lists your pending alarms and timers"""
+            own = []
+            for reminder_id, reminder in list(pending_reminders.items()):
+                if (yield from Commands.owns_reminder(responder, reminder)):
+                    own.append((reminder['due'], reminder_id, reminder))
+            own.sort()
+            if len(own) == 0:
+                responder("You have no pending reminders")
+
+            for due, reminder_id, reminder in own:
+                responder("{}: {} - {}".format(
+                    reminder_id, datetime.datetime.fromtimestamp(due).isoformat(),
+                    reminder['message']), msgtype='NOTICE')
+
+        @waterbug.expose
+        @asyncio.coroutine
+        def cancel(responder, reminder_id):
+            """Cancels one of your pending alarms or timers"""
+            try:
+                reminder = pending_reminders[int(reminder_id)]
+            except (KeyError, ValueError):
+                reminder = None
+
+            if reminder is None or not (yield from Commands.owns_reminder(responder, reminder)):
+                responder("No such reminder")
+                return
+
+            # it may have been run or cancelled during the account lookup
+            if pending_reminders.pop(int(reminder_id), None) is None:
+                responder("No such reminder")
+                return
+            STORAGE.sync()
+            Commands.schedule_reminders()
+            responder("Reminder {} cancelled".format(reminder_id))
 
     @waterbug.expose
     @asyncio.coroutine
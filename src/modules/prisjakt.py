@@ -1,5 +1,9 @@
 
+import array
 import asyncio
+import bisect
+import datetime
+import itertools
 import json
 import re
 import time
@@ -12,51 +16,149 @@ import lxml.html
 import waterbug
 
 login_lock = asyncio.Lock()
-login_cookie = None
 url_regex = re.compile("^(?:(?:http://)?(?:www\.)?prisjakt\.nu/produkt\.php\?p=)?(\d+)$")
 rss_url = "http://www.prisjakt.nu/minapriser.rss?user=" + CONFIG['username'] + "&.rss"
 
+# product id -> set of (server, channel, account); 'login_cookie' holds the persisted session
 watchers = STORAGE.get_data()
 
+read_entries = STORAGE.get_seen_set("read_entries", max_age=90*24*60*60)
+for entry_id in watchers.pop('read_entries', ()):
+    read_entries.add(entry_id)
+
+# (time fetched, items), invalidated by our own changes to the list
+watched_list = None
+watched_list_ttl = CONFIG.get("watched_list_ttl", 10*60)
+
+# product id -> {'name', 'times', 'prices', 'downsampled_until'}, where times and prices are
+# parallel arrays; observations older than history_full_resolution seconds are reduced to
+# the lowest and highest price of each day
+price_history = watchers.setdefault('price_history', {})
+history_full_resolution = CONFIG.get("history_full_resolution", 7*24*60*60)
+history_trend_period = CONFIG.get("history_trend_period", 30*24*60*60)
+day = 24*60*60
+
+# errors matching this mean the session is missing or expired, and are retried after logging
+# in again; any other error is passed on to the caller
+session_error_regex = re.compile(CONFIG.get(
+    "session_error_regex", r"logga(de)? in|inloggad|login|logged in|session|unauthori[sz]ed"),
+    re.IGNORECASE)
+
 class Commands(waterbug.Commands):
 
     @waterbug.expose
     class prisjakt:
 
-        @waterbug.periodic(60*60, trigger_on_start=True)
+        @waterbug.periodic(60*60, trigger_on_start=True, adaptive=True,
+                           min_seconds=CONFIG.get("feed_min_interval", 15*60),
+                           max_seconds=CONFIG.get("feed_max_interval", 6*60*60))
         @asyncio.coroutine
         def fetch_feed():
             LOGGER.info("Fetching feed")
-            body = yield from waterbug.fetch_url(rss_url)
+            body, headers = yield from waterbug.fetch_url(rss_url, return_headers=True)
             feed = feedparser.parse(body)
 
-            old_entries = watchers.get('read_entries', set())
-            watchers['read_entries'] = set()
+            changed = False
             for entry in feed['entries']:
-                if entry['id'] not in old_entries:
+                if read_entries.add(entry['id']):
+                    changed = True
+                    # the cached prices are out of date
+                    Commands.prisjakt.invalidate_watched_list()
                     link = entry['link'].split("#")[0]
                     prod_id = url_regex.match(link).group(1)
                     message = "[Prisjakt update] {} - {}".format(entry['title'], link)
 
                     for server, channel, user in watchers.get(prod_id, set()):
-                        BOT.queue_message(server, channel, user, message)
-                watchers['read_entries'].add(entry['id'])
+                        BOT.notify(server, channel, user, message)
+            read_entries.sync()
+            STORAGE.sync()
+
+            yield from Commands.prisjakt.record_prices()
             STORAGE.sync()
             LOGGER.info("Fetched feed")
+            return waterbug.PollResult(changed, waterbug.cache_lifetime(headers))
+
+        @asyncio.coroutine
+        def record_prices():
+            now = int(time.time())
+            for item in (yield from Commands.prisjakt.get_watched_list()):
+                price = re.sub("[^0-9]", "", str(item['price']).split(",")[0])
+                if len(price) == 0:
+                    continue # not in stock
+
+                history = price_history.setdefault(item['item_id'], {
+                    'times': array.array('q'),
+                    'prices': array.array('l'),
+                    'downsampled_until': 0
+                })
+                history['name'] = item['name']
+                history['times'].append(now)
+                history['prices'].append(int(price))
+                Commands.prisjakt.downsample(history, now - history_full_resolution)
+
+        def downsample(history, before):
+            """Keeps only the lowest and highest price of each whole day before the given time"""
+            cutoff = before - before % day
+            if cutoff <= history['downsampled_until']:
+                return
+
+            times, prices = history['times'], history['prices']
+            start = bisect.bisect_left(times, history['downsampled_until'])
+            end = bisect.bisect_left(times, cutoff)
+            kept = []
+            for _day, indices in itertools.groupby(range(start, end), key=lambda i: times[i] // day):
+                indices = list(indices)
+                kept.extend(sorted({min(indices, key=prices.__getitem__),
+                                    max(indices, key=prices.__getitem__)}))
+
+            history['times'] = (times[:start] + array.array('q', (times[i] for i in kept)) +
+                                times[end:])
+            history['prices'] = (prices[:start] + array.array('l', (prices[i] for i in kept)) +
+                                 prices[end:])
+            history['downsampled_until'] = cutoff
+
+        def trend(times, prices, since):
+            """Least squares slope of the prices after since, in price per day"""
+            start = bisect.bisect_left(times, since)
+            n = len(times) - start
+            if n < 2:
+                return 0.0
+            mean_t = sum(times[start:]) / n
+            mean_p = sum(prices[start:]) / n
+            var = sum((t - mean_t)**2 for t in times[start:])
+            if var == 0:
+                return 0.0
+            cov = sum((t - mean_t) * (p - mean_p) for t, p in zip(times[start:], prices[start:]))
+            return cov / var * day
 
         @asyncio.coroutine
-        def login():
-            global login_cookie
+        def login(expired=None):
+            """Returns the session cookies, logging in if there is no session or it is expired"""
             with (yield from login_lock):
-                if login_cookie is None:
+                cookies = watchers.get('login_cookie')
+                if cookies is None or cookies == expired:
                     response, body = yield from Commands.prisjakt.server_request(
                         "C_LoginAndRegistration", "login_user",
                         username=CONFIG['username'], password=CONFIG['password'],
                         request_id=1, raw_response=True, ensure_logged_in=False)
                     if body['error']:
                         raise Exception(body['message'])
-                    else:
-                        login_cookie = response.cookies
+
+                    cookies = {name: morsel.value for name, morsel in response.cookies.items()}
+                    watchers['login_cookie'] = cookies
+                    STORAGE.sync()
+                return cookies
+
+        @asyncio.coroutine
+        def with_session(request):
+            """Calls request with the session cookies, logging in again once if it expired"""
+            cookies = yield from Commands.prisjakt.login()
+            response, body = yield from request(cookies)
+            if body['error'] and session_error_regex.search(str(body.get('message', ""))):
+                LOGGER.info("Session has expired, logging in again: %s", body['message'])
+                cookies = yield from Commands.prisjakt.login(expired=cookies)
+                response, body = yield from request(cookies)
+            return response, body
 
         @waterbug.expose
         @asyncio.coroutine
@@ -92,37 +194,47 @@ class Commands(waterbug.Commands):
 
         @asyncio.coroutine
         def ajax_request(m, p):
-            yield from Commands.prisjakt.login()
-            response = yield from asyncio.wait_for(aiohttp.request(
-                'POST', "http://www.prisjakt.nu/ajax/jsonajaxserver.php", data={
-                    "m": m,
-                    "p": json.dumps(p),
-                    "t": int(time.time()*1000)
-                }, cookies=login_cookie), 5)
-            raw_body = (yield from response.read_and_close()).decode('utf-8')
-            # r'<\!--HAHA --\>', which is returned by bevaka_form, is an invalid JSON string
-            raw_body = raw_body.replace(r"\!", "!").replace(r"\>", ">")
-            body = json.loads(raw_body[len("<!-- START JSON OUTPUT:"):-len("END JSON OUTPUT -->")])
+            @asyncio.coroutine
+            def request(cookies):
+                response = yield from asyncio.wait_for(aiohttp.request(
+                    'POST', "http://www.prisjakt.nu/ajax/jsonajaxserver.php", data={
+                        "m": m,
+                        "p": json.dumps(p),
+                        "t": int(time.time()*1000)
+                    }, cookies=cookies), 5)
+                raw_body = (yield from response.read_and_close()).decode('utf-8')
+                # r'<\!--HAHA --\>', which is returned by bevaka_form, is an invalid JSON string
+                raw_body = raw_body.replace(r"\!", "!").replace(r"\>", ">")
+                body = json.loads(raw_body[len("<!-- START JSON OUTPUT:"):-len("END JSON OUTPUT -->")])
+                return response, body
+
+            _response, body = yield from Commands.prisjakt.with_session(request)
             return body
 
         @asyncio.coroutine
         def server_request(cls, method, data=None, raw_response=False,
                            ensure_logged_in=True, **params):
-            if ensure_logged_in:
-                yield from Commands.prisjakt.login()
-
             params['class'] = cls
             params['method'] = method
             if data is not None:
                 params['data'] = json.dumps(data)
 
-            args = {"data": params}
+            @asyncio.coroutine
+            def request(cookies):
+                args = {"data": params}
+                if cookies is not None:
+                    args['cookies'] = cookies
+
+                response = yield from asyncio.wait_for(aiohttp.request(
+                    'POST', 'http://www.prisjakt.nu/ajax/server.php', **args), 5)
+                body = json.loads((yield from response.read_and_close()).decode('utf-8'))
+                return response, body
+
             if ensure_logged_in:
-                args['cookies'] = login_cookie
+                response, body = yield from Commands.prisjakt.with_session(request)
+            else:
+                response, body = yield from request(None)
 
-            response = yield from asyncio.wait_for(aiohttp.request(
-                'POST', 'http://www.prisjakt.nu/ajax/server.php', **args), 5)
-            body = json.loads((yield from response.read_and_close()).decode('utf-8'))
             if raw_response:
                 return response, body
             else:
@@ -130,12 +242,19 @@ class Commands(waterbug.Commands):
 
         @asyncio.coroutine
         def get_watched_list():
-            body = yield from Commands.prisjakt.server_request(
-                "C_Sidebar", "save_lists", data=[{
-                    'current_sort': 'alpha',
-                    'list_id': 'Watch',
-                }])
-            return body['message'][0]['saved']['items']
+            global watched_list
+            if watched_list is None or time.time() - watched_list[0] > watched_list_ttl:
+                body = yield from Commands.prisjakt.server_request(
+                    "C_Sidebar", "save_lists", data=[{
+                        'current_sort': 'alpha',
+                        'list_id': 'Watch',
+                    }])
+                watched_list = time.time(), body['message'][0]['saved']['items']
+            return watched_list[1]
+
+        def invalidate_watched_list():
+            global watched_list
+            watched_list = None
 
         @waterbug.expose(require_auth=True)
         @asyncio.coroutine
@@ -151,24 +270,28 @@ class Commands(waterbug.Commands):
                     prod_ids[match.group(1)] = "http://www.prisjakt.nu/produkt.php?p={}".format(
                         match.group(1))
 
-            for prod_id in prod_ids:
-                if prod_id not in watchers:
-                    body = yield from Commands.prisjakt.ajax_request("bevaka_save", {
-                        "base_type": "1",
-                        "item_id": prod_id,
-                        "email_alert": 0,
-                        "push_alert": 0,
-                        "price_alert_type": "price_in_stock",
-                        "lovehate": "normal",
-                        "price_drop_type": "drops"
-                    })
-                    if body['error']:
-                        responder("Watch request failed for product ID {}".format(prod_id))
-                        LOGGER.error(body)
-                        continue
-
+            @asyncio.coroutine
+            def save(prod_id):
+                body = yield from Commands.prisjakt.ajax_request("bevaka_save", {
+                    "base_type": "1",
+                    "item_id": prod_id,
+                    "email_alert": 0,
+                    "push_alert": 0,
+                    "price_alert_type": "price_in_stock",
+                    "lovehate": "normal",
+                    "price_drop_type": "drops"
+                })
+                if body['error']:
+                    responder("Watch request failed for product ID {}".format(prod_id))
+                    LOGGER.error(body)
+                else:
                     watchers[prod_id] = set()
 
+            new_ids = [prod_id for prod_id in prod_ids if prod_id not in watchers]
+            if len(new_ids) > 0:
+                yield from asyncio.gather(*(save(prod_id) for prod_id in new_ids))
+                Commands.prisjakt.invalidate_watched_list()
+
             items = yield from Commands.prisjakt.get_watched_list()
             for item in items:
                 prod_id = item['item_id']
@@ -202,6 +325,17 @@ class Commands(waterbug.Commands):
                     prod_ids[match.group(1)] = "http://www.prisjakt.nu/produkt.php?p={}".format(
                         match.group(1))
 
+            @asyncio.coroutine
+            def remove(listitem_id):
+                body = yield from Commands.prisjakt.ajax_request("bevaka_remove", {
+                    "alert_id": listitem_id
+                })
+
+                if body['error']:
+                    responder("Something went wrong when trying to remove watched item")
+                    LOGGER.error(body)
+
+            removed = []
             items = yield from Commands.prisjakt.get_watched_list()
             for item in items:
                 prod_id = item['item_id']
@@ -211,7 +345,7 @@ class Commands(waterbug.Commands):
                 if prod_id not in watchers or (responder.server.name, responder.target,
                                                responder.sender.account) not in watchers[prod_id]:
                     responder("Not currently watching {}".format(item['name']))
-                    return
+                    continue
                 else:
                     watchers[prod_id].remove((responder.server.name, responder.target,
                                               responder.sender.account))
@@ -220,17 +354,37 @@ class Commands(waterbug.Commands):
 
                 if len(watchers[prod_id]) == 0:
                     del watchers[prod_id]
+                    removed.append(item['listitem_id'])
 
-                    body = yield from Commands.prisjakt.ajax_request("bevaka_remove", {
-                        "alert_id": item['listitem_id']
-                    })
-
-                    if body['error']:
-                        responder("Something went wrong when trying to remove watched item")
-                        LOGGER.error(body)
+            if len(removed) > 0:
+                yield from asyncio.gather(*(remove(listitem_id) for listitem_id in removed))
+                Commands.prisjakt.invalidate_watched_list()
 
             STORAGE.sync()
 
+        @waterbug.expose
+        def history(responder, product):
+            match = url_regex.match(product)
+            if match is None:
+                responder("Invalid URL or product ID: {}".format(product))
+                return
+
+            history = price_history.get(match.group(1))
+            if history is None or len(history['prices']) == 0:
+                responder("No price history for product ID {}".format(match.group(1)))
+                return
+
+            times, prices = history['times'], history['prices']
+            lowest = min(range(len(prices)), key=prices.__getitem__)
+            highest = max(range(len(prices)), key=prices.__getitem__)
+            date = lambda i: datetime.date.fromtimestamp(times[i]).isoformat()
+            responder("{} - {} kr, lowest {} kr ({}), highest {} kr ({}), trend {:+.1f} kr/day, "
+                      "tracked since {} - http://www.prisjakt.nu/produkt.php?p={}".format(
+                          history['name'], prices[-1], prices[lowest], date(lowest),
+                          prices[highest], date(highest),
+                          Commands.prisjakt.trend(times, prices, times[-1] - history_trend_period),
+                          date(0), match.group(1)))
+
         @waterbug.expose(require_auth=True)
         @asyncio.coroutine
         def list(responder):
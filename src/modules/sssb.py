@@ -15,8 +15,11 @@
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import asyncio
+import bisect
+import collections
 import json
 import re
+import time
 import urllib.parse
 
 import aiohttp
@@ -27,7 +30,42 @@ import waterbug
 all_locations = set()
 apartmenttypes = {"studentrum", "studentetta", "studentlägenhet"}
 
+# subscriber filters are keyed by (server, channel, account) tuples; the string keys hold
+# the last apartment snapshot and the lookups cached per detaljUrl
 filters = STORAGE.get_data()
+enrichment = filters.setdefault('enrichment', {})
+# apartments which have been announced, so that a listing which briefly disappears from the
+# list isn't announced again when it comes back
+notified = STORAGE.get_seen_set("notified", max_age=60*24*60*60)
+snapshot_lock = asyncio.Lock()
+max_snapshot_age = CONFIG.get("max_snapshot_age", 60*60)
+
+# maximum number of apartments being looked up concurrently
+max_concurrent_lookups = CONFIG.get("max_concurrent_lookups", 5)
+enrichment_semaphore = asyncio.Semaphore(max_concurrent_lookups)
+
+# short URLs are served by the bot itself if a public base_url is configured; this is
+# used as a fallback when the Google API fails, or exclusively if backend is "local" or
+# there is no Google API key
+shortener_config = CONFIG.get("shortener", {})
+local_shortener = None
+if "base_url" in shortener_config:
+    local_shortener = waterbug.LocalShortener(shortener_config['base_url'],
+                                              filters.setdefault('short_codes', {}),
+                                              shortener_config.get('host', "0.0.0.0"),
+                                              shortener_config.get('port', 8080))
+if shortener_config.get('backend', "google") == "local" or 'googlkey' not in CONFIG:
+    if local_shortener is None:
+        LOGGER.warning("Neither a Google API key nor a base_url is configured, "
+                       "URLs won't be shortened")
+    shortener = waterbug.URLShortener(filters.setdefault('short_urls', {}),
+                                      local_shortener, sync=STORAGE.sync,
+                                      max_concurrent=max_concurrent_lookups)
+else:
+    shortener = waterbug.URLShortener(filters.setdefault('short_urls', {}),
+                                      waterbug.GoogleShortener(CONFIG['googlkey']),
+                                      local_shortener, sync=STORAGE.sync,
+                                      max_concurrent=max_concurrent_lookups)
 
 checks = {
     "locations": lambda apartment, x: apartment['omradeKod'].lower() in x,
@@ -37,8 +75,85 @@ checks = {
     "maxqueuedays": lambda apartment, x: apartment['kodagar'] <= x
 }
 
+# filter name -> (apartment field, whether the filter value is an upper bound)
+thresholds = {
+    "maxrent": ("hyra", True),
+    "minarea": ("yta", False),
+    "maxqueuedays": ("kodagar", True)
+}
+
+filter_index = None
+
+
+class FilterIndex:
+    """All subscriber filters compiled so that an apartment can be matched in one pass"""
+
+    def __init__(self, filters):
+        self.keys = []
+        self.locations = collections.defaultdict(set)
+        self.any_location = set()
+        self.apartmenttypes = collections.defaultdict(set)
+        self.any_apartmenttype = set()
+        bounds = {valname: [] for valname in thresholds}
+
+        for key, fltrs in filters.items():
+            if not isinstance(key, tuple):
+                continue
+
+            for fltr in fltrs:
+                filter_id = len(self.keys)
+                self.keys.append(key)
+                FilterIndex._add_choices(filter_id, fltr.get('locations'),
+                                         self.locations, self.any_location)
+                FilterIndex._add_choices(filter_id, fltr.get('apartmenttype'),
+                                         self.apartmenttypes, self.any_apartmenttype)
+                for valname, values in bounds.items():
+                    if valname in fltr:
+                        values.append((fltr[valname], filter_id))
+
+        # valname -> (sorted bounds, filter ids in the same order, unconstrained filter ids)
+        self.bounds = {}
+        for valname, values in bounds.items():
+            values.sort()
+            unconstrained = set(range(len(self.keys))) - {filter_id for _, filter_id in values}
+            self.bounds[valname] = ([bound for bound, _ in values],
+                                    [filter_id for _, filter_id in values],
+                                    unconstrained)
+
+    @staticmethod
+    def _add_choices(filter_id, choices, index, unconstrained):
+        if choices is None:
+            unconstrained.add(filter_id)
+        else:
+            for choice in choices:
+                index[choice].add(filter_id)
+
+    def match(self, apartment):
+        """Returns the keys of all subscribers with a filter matching the apartment"""
+        candidates = self.locations.get(apartment['omradeKod'].lower(), set()) | self.any_location
+        candidates &= (self.apartmenttypes.get(apartment['typOvergripande'].lower(), set()) |
+                       self.any_apartmenttype)
+
+        for valname, (bounds, filter_ids, unconstrained) in self.bounds.items():
+            if len(candidates) == 0:
+                break
+            field, upper_bound = thresholds[valname]
+            if upper_bound:
+                satisfied = filter_ids[bisect.bisect_left(bounds, apartment[field]):]
+            else:
+                satisfied = filter_ids[:bisect.bisect_right(bounds, apartment[field])]
+            candidates &= unconstrained.union(satisfied)
+
+        return {self.keys[filter_id] for filter_id in candidates}
+
+
 class Commands(waterbug.Commands):
 
+    @waterbug.trigger
+    def unload():
+        if local_shortener is not None:
+            local_shortener.stop()
+
     @asyncio.coroutine
     def init():
         global all_locations
@@ -49,42 +164,133 @@ class Commands(waterbug.Commands):
                             if len(option.get('value')) > 0)
 
 
-    @waterbug.periodic(60*60*8, trigger_on_start=True)
+    @waterbug.periodic(60*60*8, trigger_on_start=True, adaptive=True,
+                       min_seconds=CONFIG.get("min_interval", 60*60),
+                       max_seconds=CONFIG.get("max_interval", 60*60*12))
     @asyncio.coroutine
     def fetch_new_apartments():
         LOGGER.info("Fetching apartments")
+        changed = yield from Commands.refresh_snapshot()
+        LOGGER.info("Fetched apartments")
+        return changed
 
-        old_apartments = filters.get("seen_apartments", set())
-        filters['seen_apartments'] = set()
-        for apartment in (yield from Commands.fetch_apartments()):
-            filters['seen_apartments'].add((apartment['omrade'], apartment['adress'],
-                                            apartment['kodagar']))
-            if (apartment['omrade'], apartment['adress'], apartment['kodagar']) in old_apartments:
-                continue
+    def apartment_id(apartment):
+        # the refid in the detail URL identifies the object
+        return urllib.parse.urlparse(apartment['detaljUrl']).query
 
-            for k, fltrs in filters.items():
-                if k == 'seen_apartments':
-                    continue
+    def diff_apartments(old, new):
+        """Returns the ids of added, changed and removed apartments"""
+        added = new.keys() - old.keys()
+        removed = old.keys() - new.keys()
+        changed = {apartment_id for apartment_id in new.keys() & old.keys()
+                   if new[apartment_id] != old[apartment_id]}
+        return added, changed, removed
 
-                server, channel, user = k
-                if any(all(checks[valname](apartment, val)
-                           for valname, val in fltr.items())
-                       for fltr in fltrs):
-                    message = yield from Commands.format_message(apartment)
-                    BOT.queue_message(server, channel, user, message)
+    @asyncio.coroutine
+    def refresh_snapshot():
+        """Fetches the apartments and notifies subscribers
+
+        Returns whether apartments were added or removed; changes to the number of applicants
+        happen all the time and don't count, so that the polling interval can back off.
+        """
+        with (yield from snapshot_lock):
+            apartments = {Commands.apartment_id(apartment): apartment
+                          for apartment in (yield from Commands.fetch_apartments())}
+
+            if 'snapshot' in filters:
+                old_apartments = filters['snapshot']['apartments']
+            else:
+                # no snapshot yet, treat everything in the old seen_apartments set as known
+                seen = filters.pop('seen_apartments', set())
+                old_apartments = {
+                    apartment_id: apartment for apartment_id, apartment in apartments.items()
+                    if (apartment['omrade'], apartment['adress'], apartment['kodagar']) in seen}
+
+            added, changed, removed = Commands.diff_apartments(old_apartments, apartments)
+            LOGGER.info("%d new, %d changed and %d removed apartments",
+                        len(added), len(changed), len(removed))
+
+            index = Commands.get_filter_index()
+            notifications = []
+            for apartment_id in added:
+                if not notified.add(apartment_id):
+                    continue
+                recipients = index.match(apartments[apartment_id])
+                if len(recipients) > 0:
+                    notifications.append((apartments[apartment_id], recipients))
+            for apartment_id in changed:
+                # only notify subscribers whose filters didn't match the previous version
+                recipients = (index.match(apartments[apartment_id]) -
+                              index.match(old_apartments[apartment_id]))
+                if len(recipients) > 0:
+                    notifications.append((apartments[apartment_id], recipients))
+            for apartment_id in removed:
+                enrichment.pop(old_apartments[apartment_id]['detaljUrl'], None)
+                shortener.forget(old_apartments[apartment_id]['detaljUrl'])
+
+            filters['snapshot'] = {'time': time.time(), 'apartments': apartments}
+            notified.sync()
+
+        messages = yield from Commands.format_messages(
+            [apartment for apartment, _recipients in notifications])
+        for (apartment, recipients), message in zip(notifications, messages):
+            for server, channel, user in recipients:
+                BOT.notify(server, channel, user, message)
 
         STORAGE.sync()
-        LOGGER.info("Fetched apartments")
+        return len(added) + len(removed) > 0
+
+    def get_filter_index():
+        global filter_index
+        if filter_index is None:
+            filter_index = FilterIndex(filters)
+        return filter_index
+
+    def invalidate_filter_index():
+        global filter_index
+        filter_index = None
+
+    def matches(apartment, fltrs):
+        return any(all(checks[valname](apartment, val)
+                       for valname, val in fltr.items())
+                   for fltr in fltrs)
+
+    @asyncio.coroutine
+    def format_messages(apartments):
+        """Formats all apartments concurrently"""
+        yield from shortener.shorten_many([apartment['detaljUrl'] for apartment in apartments])
+        return (yield from asyncio.gather(*(Commands.format_message(apartment)
+                                            for apartment in apartments)))
+
+    @asyncio.coroutine
+    def cached_booking_date(url):
+        if url not in enrichment:
+            enrichment[url] = {'booking_date': (yield from Commands.fetch_booking_date(url))}
+        return enrichment[url]['booking_date']
 
     @asyncio.coroutine
     def format_message(apartment):
-        shorturl = yield from Commands.shorten_url(apartment['detaljUrl'])
-        booking_date = yield from Commands.fetch_booking_date(apartment['detaljUrl'])
+        """Formats apartment, leaving out the booking date and short URL if they can't be had"""
+        url = apartment['detaljUrl']
+        with (yield from enrichment_semaphore):
+            shorturl, booking_date = yield from asyncio.gather(
+                shortener.shorten(url), Commands.cached_booking_date(url),
+                return_exceptions=True)
+
+        if isinstance(shorturl, Exception):
+            LOGGER.error("Couldn't shorten %s: %r", url, shorturl)
+            shorturl = url
+        bokning = ""
+        if isinstance(booking_date, Exception):
+            # not cached, so the next notification for the apartment tries again
+            LOGGER.error("Couldn't look up the booking date of %s: %r", url, booking_date)
+        else:
+            bokning = "bokning {} · ".format(booking_date)
 
         return "[{omrade}] {typOvergripande} {yta} m² · {egenskaper} · " \
-               "{adress} ({vaning}) · {hyra} kr/mån · bokning {bokning} · " \
+               "{adress} ({vaning}) · {hyra} kr/mån · {bokning}" \
                "inflyttning {inflyttningDatum} · {antalIntresse} · {url}".format(
-                   url=shorturl, bokning=booking_date, **apartment)
+                   url=shorturl, bokning=bokning, **apartment)
 
     @asyncio.coroutine
     def fetch_raw_apartments():
@@ -125,15 +331,6 @@ class Commands(waterbug.Commands):
                                                 booking_data['html']['objektintresse']).groups()
         return booking_date
 
-    @asyncio.coroutine
-    def shorten_url(url):
-        data = yield from waterbug.fetch_url(
-            "https://www.googleapis.com/urlshortener/v1/url?key={}".format(
-                CONFIG['googlkey']),
-            method="POST", data=json.dumps({"longUrl": url}),
-            headers={"Content-Type": "application/json"})
-        return json.loads(data.decode('utf-8'))['id']
-
     @waterbug.expose
     class sssb:
 
@@ -174,6 +371,7 @@ class Commands(waterbug.Commands):
                 if val != defaults[valname]
             })
 
+            Commands.invalidate_filter_index()
             STORAGE.sync()
             responder("Filter added")
 
@@ -181,6 +379,7 @@ class Commands(waterbug.Commands):
         def clearfilters(responder):
             if (responder.server.name, responder.target, responder.sender.account) in filters:
                 del filters[(responder.server.name, responder.target, responder.sender.account)]
+                Commands.invalidate_filter_index()
                 STORAGE.sync()
                 responder("All filters cleared")
             else:
@@ -214,16 +413,21 @@ class Commands(waterbug.Commands):
             else:
                 fltrs = filters[(responder.server.name, responder.target,
                                  responder.sender.account)]
-                no_matches = True
-                for apartment in (yield from Commands.fetch_apartments()):
-                    if any(all(checks[valname](apartment, val)
-                               for valname, val in fltr.items())
-                           for fltr in fltrs):
-                        no_matches = False
-                        responder((yield from Commands.format_message(apartment)))
-
-                if no_matches:
+                snapshot = filters.get('snapshot')
+                if snapshot is None or time.time() - snapshot['time'] > max_snapshot_age:
+                    yield from Commands.refresh_snapshot()
+
+                matches = sorted((apartment
+                                  for apartment in filters['snapshot']['apartments'].values()
+                                  if Commands.matches(apartment, fltrs)),
+                                 key=lambda x: x['omrade'])
+                for message in (yield from Commands.format_messages(matches)):
+                    responder(message)
+
+                if len(matches) == 0:
                     responder("No matching items found")
 
 
 asyncio.async(Commands.init())
+if local_shortener is not None:
+    asyncio.async(local_shortener.start())
@@ -0,0 +1,41 @@
+#   Waterbug, a modular IRC bot written using Python 3
+#   Copyright (C) 2011  Arvid Fahlström Myrman
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from waterbug.network import Server
+
+
+class ParseAddressTest(unittest.TestCase):
+
+    def test_hostname(self):
+        self.assertEqual(Server.parse_address("irc.example.org", 6667), ("irc.example.org", 6667))
+        self.assertEqual(Server.parse_address("irc.example.org:6697", 6667),
+                         ("irc.example.org", 6697))
+
+    def test_ipv4(self):
+        self.assertEqual(Server.parse_address("127.0.0.1", 6667), ("127.0.0.1", 6667))
+        self.assertEqual(Server.parse_address("127.0.0.1:6697", 6667), ("127.0.0.1", 6697))
+
+    def test_ipv6(self):
+        self.assertEqual(Server.parse_address("::1", 6667), ("::1", 6667))
+        self.assertEqual(Server.parse_address("2001:db8::6697", 6667), ("2001:db8::6697", 6667))
+        self.assertEqual(Server.parse_address("[::1]", 6667), ("::1", 6667))
+        self.assertEqual(Server.parse_address("[::1]:6697", 6667), ("::1", 6697))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -16,4 +16,8 @@
 
 from .bot import *
 from .network import *
+from .dedup import *
+from .digest import *
+from .scheduler import *
+from .shortener import *
 from .constants import *
@@ -34,6 +34,9 @@ import jsonschema
 
 from . import network
 from .constants import *
+from .dedup import SeenSet
+from .digest import NotificationDigest
+from .scheduler import Scheduler, Job
 
 class Waterbug:
 
@@ -41,11 +44,11 @@ class Waterbug:
         self.servers = {}
         self.commands = {}
         self.modules = []
-        self.queued_messages = {}
         self.async_operations = {}
-        self.periodic_callbacks = []
 
         self.data = shelve.open("data.pck")
+        # server name -> account -> channel -> messages
+        self.queued_messages = self.data.get("waterbug:queued_messages", {})
 
         with open("config.json") as config:
             self.config = json.load(config)
@@ -87,7 +90,22 @@ class Waterbug:
                             },
                             "quit_msg": { "type": "string" },
                             "inencoding": { "type": "string" },
-                            "outencoding": { "type": "string" }
+                            "outencoding": { "type": "string" },
+                            "fallback_servers": {
+                                "type": "array",
+                                "items": { "type": "string" }
+                            },
+                            "max_reconnects": {
+                                "type": ["integer", "null"],
+                                "default": None
+                            },
+                            "reconnect_delay": { "type": "number" },
+                            "max_reconnect_delay": { "type": "number" },
+                            "tls": { "type": "boolean" },
+                            "tls_verify": { "type": "boolean" },
+                            "tls_cafile": { "type": "string" },
+                            "tls_certfile": { "type": "string" },
+                            "tls_keyfile": { "type": "string" }
                         },
                         "additionalProperties": False,
                         "required": ["prefix", "server", "port", "username"]
@@ -108,6 +126,10 @@ class Waterbug:
                     server_config['privileges'][k] = globals()[v]
 
         self.loop = loop or asyncio.get_event_loop()
+        self.scheduler = Scheduler(loop=self.loop)
+        self.digest = NotificationDigest(self.queue_message,
+                                         self.data.get("waterbug:digest", {}),
+                                         self.more_hint, sync=self.sync_digest, loop=self.loop)
         self._future = None
 
     @asyncio.coroutine
@@ -136,11 +158,19 @@ class Waterbug:
             self.servers[name] = server
 
             server.add_callback(self.on_privmsg, {"PRIVMSG"})
-            server.add_callback(self.handle_queued_messages, {"PRIVMSG", "315"})
+            server.add_callback(self.on_user_update,
+                                {"JOIN", "ACCOUNT", network.Server.account_known_event})
+            server.add_callback(self.on_whox, {"354"})
 
             _open_connection(server)
 
     def quit(self):
+        # keep notifications still waiting for their digest until the next start
+        for connection, channel, account, message in self.digest.drain():
+            self.queued_messages.setdefault(connection, {}).setdefault(account, {}) \
+                                .setdefault(channel, []).append(message)
+        self.sync_queued_messages()
+
         for server in self.servers.values():
             server.quit()
         self.unload_modules()
@@ -158,9 +188,7 @@ class Waterbug:
             future.cancel()
         self.async_operations = {}
 
-        for periodic_callback in self.periodic_callbacks:
-            periodic_callback.stop()
-        self.periodic_callbacks = []
+        self.scheduler.clear()
 
     def load_modules(self):
         self.unload_modules()
@@ -192,8 +220,7 @@ class Waterbug:
                             command_dict[name] = {}
                             add_commands(value, command_dict[name])
                     if getattr(value, "_period", None) is not None:
-                        self.periodic_callbacks.append(value._period)
-                        value._period.start()
+                        self.scheduler.add(value._period)
 
             module.commands = module.Commands
             add_commands(module.commands, self.commands)
@@ -214,6 +241,10 @@ class Waterbug:
         def get_data(self):
             return self.data
 
+        def get_seen_set(self, key, capacity=10000, max_age=None):
+            """Returns a SeenSet which is stored separately from the module data"""
+            return SeenSet.open(self._data, "{}:{}".format(self.name, key), capacity, max_age)
+
     class Responder:
 
         def __init__(self, bot, server, sender, target, receiver, line):
@@ -306,23 +337,64 @@ class Waterbug:
                 server.msg(target, "You do not have access to this command")
 
     def queue_message(self, connection, channel, account, message):
-        self.queued_messages.setdefault((connection, channel, account), []).append(message)
-        self.handle_queued_messages()
-
-    def handle_queued_messages(self, *_args):
-        to_remove = set()
-        for (connection, channel, account), messages in self.queued_messages.items():
-            if connection in self.servers and channel in self.servers[connection].channels:
-                user = next((u for u in self.servers[connection].channels[channel].users.values()
-                             if u.account == account), None)
-                if user is not None:
-                    for message in messages:
-                        self.servers[connection].msg(channel, "{}: {}".format(
-                            user.username, message))
-                    to_remove.add((connection, channel, account))
-
-        for i in to_remove:
-            del self.queued_messages[i]
+        """Sends message to the user logged in as account once they are in channel"""
+        self.queued_messages.setdefault(connection, {}).setdefault(account, {}) \
+                            .setdefault(channel, []).append(message)
+        self.sync_queued_messages()
+
+        server = self.servers.get(connection)
+        if server is not None:
+            for user in server.users_by_account(account):
+                self.deliver_queued_messages(server, user)
+
+    def notify(self, connection, channel, account, message):
+        """Like queue_message, but merges notifications sent close together into a digest"""
+        self.digest.add(connection, channel, account, message)
+
+    def more_hint(self, connection):
+        server = self.servers.get(connection)
+        return "{}more".format(server.prefix if server is not None else "")
+
+    def sync_digest(self):
+        self.data["waterbug:digest"] = self.digest.state
+        self.data.sync()
+
+    def deliver_queued_messages(self, server, user):
+        if user.account is None:
+            return
+        pending = self.queued_messages.get(server.name, {}).get(user.account)
+        if pending is None:
+            return
+
+        channels = [channel for channel in pending if channel in user.knownchannels]
+        if len(channels) == 0:
+            return
+
+        for channel in channels:
+            for message in pending.pop(channel):
+                server.msg(channel, "{}: {}".format(user.username, message))
+
+        if len(pending) == 0:
+            del self.queued_messages[server.name][user.account]
+            if len(self.queued_messages[server.name]) == 0:
+                del self.queued_messages[server.name]
+        self.sync_queued_messages()
+
+    def sync_queued_messages(self):
+        self.data["waterbug:queued_messages"] = self.queued_messages
+        self.data.sync()
+
+    # queued messages can only become deliverable when a user joins a channel or
+    # their account becomes known, which includes users restored after a reconnect
+
+    def on_user_update(self, server, event, sender, *_args):
+        self.deliver_queued_messages(server, sender)
+
+    def on_whox(self, server, event, sender, target, *fields):
+        # the nick is followed by the flags, account and realname
+        nick = fields[-4]
+        if nick in server.users:
+            self.deliver_queued_messages(server, server.users[nick])
 
 def _make_static(cls):
     for name, val in vars(cls).items():
@@ -374,12 +446,11 @@ def expose(*args, **kwargs):
             @asyncio.coroutine
             @functools.wraps(target)
             def new_target(responder, *args, **kwargs):
-                responder.server.who(responder.sender.username)
-                user = None
-                while user != responder.sender.username:
+                # without the IRCv3 account capabilities, ask the server for the account
+                if not responder.server.tracks_account(responder.sender):
                     try:
-                        _server, _mtype, _sender, _receiver, user, _message = \
-                            yield from asyncio.wait_for(responder.server.on("315"), 10)
+                        responder.sender.account = yield from responder.server.lookup_account(
+                            responder.sender)
                     except asyncio.TimeoutError:
                         responder("Error: WHO request failed")
                         return
@@ -408,51 +479,9 @@ def trigger(target):
     return target
 
 
-class _PeriodicCallback:
-
-    def __init__(self, callback, seconds, trigger_on_start, *, loop=None):
-        self.callback = callback
-        self.seconds = seconds
-        self.trigger_on_start = trigger_on_start
-        self.loop = loop or asyncio.get_event_loop()
-        self.task = None
-
-    def start(self):
-        assert self.task is None, "The periodic callback is already running"
-        self.task = asyncio.async(self.run(), loop=self.loop)
-
-    def stop(self):
-        assert self.task is not None, "The periodic callback is not running"
-        self.task.cancel()
-        self.task = None
-
-    @asyncio.coroutine
-    def run(self):
-        logging.info("Starting %s", self.callback.__name__)
-        try:
-            if self.trigger_on_start:
-                yield from self.run_once()
-
-            while True:
-                yield from asyncio.sleep(self.seconds)
-                yield from self.run_once()
-        except asyncio.CancelledError:
-            logging.info("Stopping %s", self.callback.__name__)
-
-    @asyncio.coroutine
-    def run_once(self):
-        try:
-            res = self.callback()
-            if asyncio.iscoroutine(res):
-                yield from res
-        except asyncio.CancelledError:
-            raise
-        except Exception:
-            logging.exception("Error in %s", self.callback.__name__)
-
-
-def periodic(seconds, trigger_on_start=False):
+def periodic(seconds=None, trigger_on_start=False, **kwargs):
+    """Runs the target on the bot's scheduler while its module is loaded; see Job"""
     def decorator(target):
-        target._period = _PeriodicCallback(target, seconds, trigger_on_start)
+        target._period = Job(target, seconds, trigger_on_start, **kwargs)
         return target
     return decorator
@@ -0,0 +1,106 @@
+#   Waterbug, a modular IRC bot written using Python 3
+#   Copyright (C) 2011  Arvid Fahlström Myrman
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['SeenSet']
+
+import array
+import collections
+import hashlib
+import time
+
+
+class SeenSet:
+    """Bounded set of recently seen ids, used to deduplicate feed items
+
+    Ids are kept as 64-bit hashes in insertion order. When more than capacity ids have been
+    added, or an id is older than max_age seconds, the oldest ids are forgotten. The set is
+    pickled as two flat arrays, and sync only writes it to its shelf if it has changed.
+    """
+
+    def __init__(self, capacity=10000, max_age=None):
+        self.capacity = capacity
+        self.max_age = max_age
+        self.entries = collections.OrderedDict()
+        self.shelf = None
+        self.key = None
+        self.dirty = False
+
+    @classmethod
+    def open(cls, shelf, key, capacity=10000, max_age=None):
+        seen = shelf.get(key)
+        if not isinstance(seen, cls):
+            seen = cls(capacity, max_age)
+        seen.capacity = capacity
+        seen.max_age = max_age
+        seen.shelf = shelf
+        seen.key = key
+        seen._expire()
+        return seen
+
+    @staticmethod
+    def _hash(item):
+        return int.from_bytes(hashlib.sha1(repr(item).encode('utf-8')).digest()[:8], 'big')
+
+    def __contains__(self, item):
+        return SeenSet._hash(item) in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, item):
+        """Adds item, returning whether it was new"""
+        h = SeenSet._hash(item)
+        new = h not in self.entries
+        self.entries[h] = time.time()
+        self.entries.move_to_end(h)
+        # a refreshed timestamp is written along with the next real change
+        if new:
+            self.dirty = True
+        self._expire()
+        return new
+
+    def _expire(self):
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.dirty = True
+
+        if self.max_age is not None:
+            oldest = time.time() - self.max_age
+            while len(self.entries) > 0 and next(iter(self.entries.values())) < oldest:
+                self.entries.popitem(last=False)
+                self.dirty = True
+
+    def sync(self):
+        if self.dirty and self.shelf is not None:
+            self.shelf[self.key] = self
+            self.shelf.sync()
+        self.dirty = False
+
+    def __getstate__(self):
+        return {
+            "capacity": self.capacity,
+            "max_age": self.max_age,
+            "hashes": array.array('Q', self.entries.keys()).tobytes(),
+            "times": array.array('d', self.entries.values()).tobytes()
+        }
+
+    def __setstate__(self, state):
+        hashes = array.array('Q')
+        hashes.frombytes(state["hashes"])
+        times = array.array('d')
+        times.frombytes(state["times"])
+        self.__init__(state["capacity"], state["max_age"])
+        self.entries.update(zip(hashes, times))
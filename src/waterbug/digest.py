@@ -0,0 +1,140 @@
+#   Waterbug, a modular IRC bot written using Python 3
+#   Copyright (C) 2011  Arvid Fahlström Myrman
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['NotificationDigest']
+
+import asyncio
+
+
+class NotificationDigest:
+    """Merges the notifications for a recipient into digests
+
+    Notifications to the same account in the same channel that arrive within window seconds of
+    the first one are sent together by send(connection, channel, account, message), as one
+    message of at most budget bytes. Whatever doesn't fit is kept in more, to be paged through
+    with next_page, and more_hint(connection) gives the command for that.
+
+    state is usually a dict in the bot's storage, holding the per-account windows under
+    'windows' and the pages under 'more', and sync is called whenever it has changed.
+    """
+
+    separator = " | "
+
+    def __init__(self, send, state, more_hint, sync=None, window=60, budget=250, *, loop=None):
+        self.send = send
+        self.state = state
+        self.state.setdefault('windows', {})
+        self.state.setdefault('more', {})
+        self.more_hint = more_hint
+        self.sync = sync
+        self.window = window
+        self.budget = budget
+        self.loop = loop or asyncio.get_event_loop()
+        # (connection, account, channel) -> notifications and the handle of their flush
+        self.pending = {}
+        self.handles = {}
+
+    def get_window(self, connection, account):
+        return self.state['windows'].get((connection, account), self.window)
+
+    def set_window(self, connection, account, window):
+        """Sets the window for account, 0 sending every notification by itself"""
+        if window is None:
+            self.state['windows'].pop((connection, account), None)
+        else:
+            self.state['windows'][(connection, account)] = window
+        self._sync()
+
+    def add(self, connection, channel, account, message):
+        window = self.get_window(connection, account)
+        if window <= 0:
+            self.send(connection, channel, account, message)
+            return
+
+        key = connection, account, channel
+        self.pending.setdefault(key, []).append(message)
+        if key not in self.handles:
+            self.handles[key] = self.loop.call_later(window, self.flush, key)
+
+    def flush(self, key):
+        handle = self.handles.pop(key, None)
+        if handle is not None:
+            handle.cancel()
+        messages = self.pending.pop(key, [])
+        connection, account, channel = key
+        if len(messages) == 1:
+            self.send(connection, channel, account, messages[0])
+        elif len(messages) > 1:
+            digest, rest = self.compose(messages, "{} new notifications: ".format(len(messages)),
+                                        connection)
+            if len(rest) > 0:
+                self.state['more'].setdefault((connection, account), []).extend(rest)
+                self._sync()
+            self.send(connection, channel, account, digest)
+
+    def drain(self):
+        """Cancels all pending digests, returning their notifications"""
+        for handle in self.handles.values():
+            handle.cancel()
+        notifications = [(connection, channel, account, message)
+                         for (connection, account, channel), messages in self.pending.items()
+                         for message in messages]
+        self.pending = {}
+        self.handles = {}
+        return notifications
+
+    def next_page(self, connection, account):
+        """Returns the next page of notifications that didn't fit in a digest, or None"""
+        messages = self.state['more'].pop((connection, account), [])
+        if len(messages) == 0:
+            return None
+
+        page, rest = self.compose(messages, "", connection)
+        if len(rest) > 0:
+            self.state['more'][(connection, account)] = rest
+        self._sync()
+        return page
+
+    def compose(self, messages, header, connection):
+        """Joins as many messages as fit in the budget, returning the text and the rest"""
+        def size(text):
+            return len(text.encode('utf-8'))
+
+        def hint(count):
+            return " (+{} more, see {})".format(count, self.more_hint(connection))
+
+        text = header
+        for i, message in enumerate(messages):
+            part = (self.separator if i > 0 else "") + message
+            # leave room for the hint unless this is the last message
+            reserved = size(hint(len(messages) - i - 1)) if i < len(messages) - 1 else 0
+            if size(text + part) + reserved > self.budget:
+                if i == 0:
+                    # a single message that is too long gets cut, keeping the rest for later
+                    room = self.budget - size(text) - size(hint(len(messages))) - 3
+                    cut = (message.encode('utf-8')[:max(room, 0)].decode('utf-8', 'ignore') or
+                           message[:1])
+                    text += cut + "..."
+                    rest = [message[len(cut):]] + messages[1:]
+                else:
+                    rest = messages[i:]
+                return text + hint(len(rest)), rest
+            text += part
+        return text, []
+
+    def _sync(self):
+        if self.sync is not None:
+            self.sync()
@@ -14,14 +14,23 @@
 #   You should have received a copy of the GNU Affero General Public License
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-__all__ = ['Server', 'Channel', 'User', 'fetch_url']
+__all__ = ['Server', 'Channel', 'User', 'fetch_url', 'cache_lifetime']
 
 import asyncio
 import collections
+import collections.abc
 import datetime
+import email.utils
+import functools
+import inspect
 import itertools
 import logging
+import random
+import re
 import socket
+import ssl
+import string
+import sys
 import time
 import traceback
 
@@ -32,16 +41,41 @@ from .constants import *
 
 class Server:
 
+    # IRCv3 capabilities requested when available
+    wanted_capabilities = frozenset({"account-notify", "extended-join", "account-tag",
+                                     "multi-prefix", "away-notify", "message-tags",
+                                     "userhost-in-names"})
+    # names of the parameters that can be waited on, for messages whose handlers don't
+    # name them
+    selector_fields = {"354": ("sender", "target", "token")}
+    # run with a user whose account became known without a message of its own telling so,
+    # such as users restored from the state before a reconnect or an account message tag
+    account_known_event = "ACCOUNT-KNOWN"
+
     def __init__(self, prefix, server, port, name, username,
                  quit_msg=None, ident=None,
                  autojoin=[], privileges=None, inencoding="irc", outencoding="utf8",
-                 reconnect=True, max_reconnects=5, connect_timeout=30,
-                 keepalive_interval=60, throttle=1, *, loop=None):
+                 reconnect=True, max_reconnects=None, connect_timeout=30,
+                 keepalive_interval=60, throttle=1, account_cache_ttl=300, who_delay=2,
+                 fallback_servers=[], reconnect_delay=1, max_reconnect_delay=300,
+                 happy_eyeballs_delay=0.25, tls=False, tls_verify=True, tls_cafile=None,
+                 tls_certfile=None, tls_keyfile=None, max_throttle=None, lag_probe_interval=10,
+                 rejoin_timeout=60, *, loop=None):
         self.loop = loop or asyncio.get_event_loop()
 
         self.prefix = prefix
-        self.channels = CaseInsensitiveDict()
-        self.users = CaseInsensitiveDict()
+        self.casemapping = "rfc1459"
+        self.channels = CaseInsensitiveDict(self.casemapping)
+        self.users = CaseInsensitiveDict(self.casemapping)
+        self.accounts = CaseInsensitiveDict(self.casemapping)
+        self.memberships = Memberships()
+        # state from before the last disconnect, and the users of rejoined channels that have
+        # to be looked up again, by channel; channels not rejoined within rejoin_timeout
+        # seconds of the welcome are forgotten
+        self.snapshot = None
+        self.names_refresh = {}
+        self.rejoin_timeout = rejoin_timeout
+        self._rejoin_handle = None
         self.inencoding = inencoding
         self.outencoding = outencoding
         self.name = name
@@ -58,34 +92,154 @@ class Server:
         self.access_list = privileges or {}
 
         self.supported = {}
+        self.available_capabilities = set()
+        self.capabilities = set()
 
         self.receiver = Server.MessageReceiver(self)
         self.callbacks = collections.defaultdict(set)
+        # (message type, parameter indices, casefolded values) -> futures waiting for it,
+        # and the parameter index tuples in use for each message type
+        self.waiters = {}
+        self.waiter_fields = collections.defaultdict(collections.Counter)
+
+        # outstanding WHO requests, by lowercased mask in the order they were sent and by
+        # WHOX token; the server answers WHOs in order, ending each with a 315 for the mask
+        self.pending_who = {}
+        self.who_requests = {}
+        self.who_tokens = itertools.cycle(range(1, 1000))
+        # casefolded nick -> (account, ident, host, expiry time) and pending account lookups
+        self.account_cache = {}
+        self.account_lookups = {}
+        self.account_cache_ttl = account_cache_ttl
+        # nicks of joining users waiting to be looked up, by channel
+        self.who_queue = collections.OrderedDict()
+        self.who_delay = who_delay
+        self._who_handle = None
 
         self.server = server
         self.port = port
+        # the servers to try, as (host, port), and which one to try first
+        self.addresses = [(server, port)] + [Server.parse_address(address, port)
+                                              for address in fallback_servers]
+        self.address_index = 0
         self.host = None
         self.connected = False
         self.welcomed = False
 
         self.reconnect = reconnect
+        # max_reconnects counts rounds through all the servers, None meaning no limit
         self.max_reconnects = max_reconnects
+        self.failed_attempts = 0
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.happy_eyeballs_delay = happy_eyeballs_delay
+
+        # the context is kept for the lifetime of the server, so that its TLS session can be
+        # resumed when reconnecting
+        self.tls_context = None
+        if tls:
+            self.tls_context = Server.create_tls_context(tls_verify, tls_cafile,
+                                                         tls_certfile, tls_keyfile)
+        # a client certificate is used to log in with SASL EXTERNAL
+        self.sasl_external = tls and tls_certfile is not None
+        self.tls_handshake_time = None
         self.connect_timeout = connect_timeout
         self.keepalive_interval = keepalive_interval
         self.throttle = throttle
+        self.max_throttle = max_throttle if max_throttle is not None else throttle * 5
         self.message_queue = asyncio.Queue()
+        # queued messages that more targets can still be added to, by command and text, and
+        # the position in the queue of the last message to each target
+        self.multi_target_messages = {}
+        self.last_queued = {}
+        self.queue_position = itertools.count()
+
+        # round-trip times measured with PING, in seconds: a moving average, the lowest and
+        # the latest one, and the tokens of the unanswered pings with their send times
+        self.lag = None
+        self.min_lag = None
+        self.last_lag = None
+        self.pings = collections.OrderedDict()
+        self.ping_tokens = itertools.count()
+        self.last_ping = None
+        self.lag_probe_interval = lag_probe_interval
         self.writer_task = None
 
         self.logger = logging.getLogger(name)
 
     @asyncio.coroutine
-    def on(self, *messagetypes):
-        future = asyncio.Future()
-        key = self.add_callback(lambda *args: future.set_result(args), messagetypes)
+    def on(self, *messagetypes, timeout=None, **selector):
+        """Waits for a message of one of the given types, returning its parameters
+
+        Only messages whose parameters, named as in the MessageReceiver handler for the
+        message type, case-insensitively equal the given keyword arguments are matched, e.g.
+        on("315", channel=nick). Raises asyncio.TimeoutError if timeout seconds pass first.
+        """
+        future = asyncio.Future(loop=self.loop)
+        keys = []
         try:
-            return (yield from future)
+            for messagetype in messagetypes:
+                keys.append(self._add_waiter(future, messagetype, selector))
+            if timeout is None:
+                return (yield from future)
+            else:
+                return (yield from asyncio.wait_for(future, timeout, loop=self.loop))
         finally:
-            self.remove_callback(key)
+            for key in keys:
+                self._remove_waiter(future, key)
+
+    def _selector_index(self, messagetype, field):
+        names = Server.selector_fields.get(messagetype)
+        if names is None:
+            handler = (getattr(self.receiver, messagetype, None) or
+                       getattr(self.receiver, "_" + messagetype, None))
+            names = [] if handler is None else [
+                parameter.name for parameter in inspect.signature(handler).parameters.values()
+                if parameter.kind == inspect.Parameter.POSITIONAL_OR_KEYWORD]
+        if field not in names:
+            raise ValueError("Can't select {} messages by {}".format(messagetype, field))
+        return names.index(field)
+
+    def _selector_value(self, value):
+        if isinstance(value, User):
+            value = value.username
+        return self.fold(str(value))
+
+    def _add_waiter(self, future, messagetype, selector):
+        fields = sorted(selector)
+        indices = tuple(self._selector_index(messagetype, field) for field in fields)
+        key = messagetype, indices, tuple(self._selector_value(selector[field])
+                                          for field in fields)
+        self.waiters.setdefault(key, []).append(future)
+        self.waiter_fields[messagetype][indices] += 1
+        return key
+
+    def _remove_waiter(self, future, key):
+        messagetype, indices, _ = key
+        futures = self.waiters.get(key, [])
+        if future in futures:
+            futures.remove(future)
+            if len(futures) == 0:
+                del self.waiters[key]
+        fields = self.waiter_fields[messagetype]
+        fields[indices] -= 1
+        if fields[indices] <= 0:
+            del fields[indices]
+            if len(fields) == 0:
+                del self.waiter_fields[messagetype]
+
+    def wake_waiters(self, messagetype, sender, *parameters):
+        if messagetype not in self.waiter_fields:
+            return
+
+        values = (sender,) + parameters
+        for indices in list(self.waiter_fields[messagetype]):
+            if len(indices) > 0 and max(indices) >= len(values):
+                continue
+            key = messagetype, indices, tuple(self._selector_value(values[i]) for i in indices)
+            for future in self.waiters.pop(key, ()):
+                if not future.done():
+                    future.set_result((self, messagetype) + values)
 
     def add_callback(self, callback, flags):
         keys = set()
@@ -102,6 +256,7 @@ class Server:
             self.callbacks[key[2]].remove(key)
 
     def run_callbacks(self, flag, *parameters):
+        self.wake_waiters(flag, *parameters)
         for _, callback, _, _ in self.callbacks[flag]:
             try:
                 callback(self, flag, *parameters)
@@ -110,9 +265,32 @@ class Server:
                                       callback.__name__, parameters)
 
     def reset_connection(self):
-        self.channels = CaseInsensitiveDict()
-        self.users = CaseInsensitiveDict()
+        # keep what was known about channels and their users, so that after reconnecting
+        # only what has changed in the meantime has to be looked up
+        if len(self.channels) > 0:
+            self.snapshot = StateSnapshot(self, self.snapshot)
+        self.names_refresh = {}
+        if self._rejoin_handle is not None:
+            self._rejoin_handle.cancel()
+            self._rejoin_handle = None
+        self.casemapping = "rfc1459"
+        self.channels = CaseInsensitiveDict(self.casemapping)
+        self.users = CaseInsensitiveDict(self.casemapping)
+        self.accounts = CaseInsensitiveDict(self.casemapping)
+        self.memberships = Memberships()
         self.supported = {}
+        self.available_capabilities = set()
+        self.capabilities = set()
+        for requests in self.pending_who.values():
+            for request in requests:
+                request.future.cancel()
+        self.pending_who = {}
+        self.who_requests = {}
+        self.account_cache = {}
+        self.who_queue = collections.OrderedDict()
+        if self._who_handle is not None:
+            self._who_handle.cancel()
+            self._who_handle = None
         self.connected = False
         self.welcomed = False
         self.writer.close()
@@ -120,37 +298,169 @@ class Server:
             self.writer_task.cancel()
             self.writer_task = None
         self.message_queue = asyncio.Queue()
+        self.multi_target_messages = {}
+        self.last_queued = {}
         self._keepalive_handler.cancel()
+        # the lag is measured anew for every connection, which may be to another server
+        self.lag = None
+        self.min_lag = None
+        self.last_lag = None
+        self.pings = collections.OrderedDict()
+        self.last_ping = None
+
+    @staticmethod
+    def parse_address(address, default_port):
+        # a port may only follow an IPv6 address in brackets, as in [::1]:6697
+        if address.startswith("["):
+            host, _, port = address[1:].partition("]")
+            port = port[1:] if port.startswith(":") else ""
+        elif address.count(":") == 1:
+            host, _, port = address.partition(":")
+        else:
+            return address, default_port
+        return host, int(port) if port.isdigit() else default_port
 
     @asyncio.coroutine
     def connect(self):
-        self.logger.info("Connecting to %s (%s:%s)", self.name, self.server, self.port)
-
-        for attempt in range(self.max_reconnects):
-            if attempt > 0:
-                self.logger.warning("Connection attempt timed out, retrying...")
-
-            try:
-                self.reader, self.writer = yield from asyncio.wait_for(
-                    asyncio.open_connection(self.server, self.port, loop=self.loop),
-                    self.connect_timeout)
-                self.connected = True
+        # the counter is reset once the server welcomes us, so connections that keep failing
+        # or dropping before registration back off, while the first reconnect is immediate
+        while True:
+            if self.max_reconnects is not None and self.failed_attempts >= self.max_reconnects:
+                self.logger.warning("Maximum number of connection attempts exceeded, giving up...")
+                self.reconnect = False
+                return
+
+            if self.failed_attempts > 0:
+                # when retrying forever, keep the exponent from overflowing a float
+                delay = min(self.reconnect_delay * 2 ** min(self.failed_attempts - 1, 32),
+                            self.max_reconnect_delay)
+                # spread out the reconnects of clients that lost their connections together
+                delay = random.uniform(delay / 2, delay)
+                self.logger.warning("Connection attempt failed, retrying in %.1f seconds", delay)
+                yield from asyncio.sleep(delay, loop=self.loop)
+            self.failed_attempts += 1
+
+            if (yield from self.connect_any()):
                 break
-            except asyncio.TimeoutError:
-                pass # continue
-        else:
-            # connection attempt failed
-            self.logger.warning("Maximum number of connection attempts exceeded, giving up...")
-            self.reconnect = False
-            return
+
+        self.connected = True
 
         self.writer_task = asyncio.async(self.handle_write(), loop=self.loop)
 
+        # registration is held until CAP END by servers supporting capability negotiation,
+        # and other servers simply ignore the command
+        self.write("CAP LS 302")
         self.nick(self.username)
         self.user(self.ident)
 
         yield from self.read()
 
+    @asyncio.coroutine
+    def connect_any(self):
+        """Tries each server in turn, starting with the last one that worked"""
+        for i in range(len(self.addresses)):
+            index = (self.address_index + i) % len(self.addresses)
+            host, port = self.addresses[index]
+            self.logger.info("Connecting to %s (%s:%s)", self.name, host, port)
+            try:
+                self.reader, self.writer = yield from asyncio.wait_for(
+                    self.open_connection(host, port), self.connect_timeout, loop=self.loop)
+            except (OSError, asyncio.TimeoutError) as e:
+                self.logger.warning("Couldn't connect to %s:%s: %s", host, port,
+                                    e if str(e) else "timed out")
+            else:
+                self.address_index = index
+                return True
+        return False
+
+    @asyncio.coroutine
+    def open_connection(self, host, port):
+        """Connects to whichever address of host answers first
+
+        Connection attempts are started happy_eyeballs_delay seconds apart, or as soon as the
+        previous one fails, alternating between IPv6 and IPv4 addresses (RFC 6555).
+        """
+        infos = yield from self.loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        families = collections.OrderedDict()
+        for info in infos:
+            families.setdefault(info[0], []).append(info)
+        infos = iter([info for infos in itertools.zip_longest(*families.values())
+                      for info in infos if info is not None])
+
+        pending = set()
+        error = None
+        sock = None
+        try:
+            while sock is None:
+                info = next(infos, None)
+                if info is not None:
+                    pending.add(asyncio.async(self._connect_socket(*info), loop=self.loop))
+                elif len(pending) == 0:
+                    break
+
+                done, pending = yield from asyncio.wait(
+                    pending, timeout=self.happy_eyeballs_delay if info is not None else None,
+                    return_when=asyncio.FIRST_COMPLETED, loop=self.loop)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif sock is None:
+                        sock = task.result()
+                    else:
+                        task.result().close()
+        finally:
+            for task in pending:
+                task.cancel()
+
+        if sock is None:
+            raise error or OSError("No addresses found for {}".format(host))
+        if self.tls_context is None:
+            return (yield from asyncio.open_connection(sock=sock, loop=self.loop))
+
+        start = time.monotonic()
+        try:
+            reader, writer = yield from asyncio.open_connection(
+                sock=sock, ssl=self.tls_context, server_hostname=host, loop=self.loop)
+        except BaseException:
+            sock.close()
+            raise
+        self.tls_handshake_time = time.monotonic() - start
+        ssl_object = writer.get_extra_info("ssl_object")
+        self.logger.info("TLS handshake with %s took %.0f ms (%s, %s)", host,
+                         self.tls_handshake_time * 1000, writer.get_extra_info("cipher")[0],
+                         "resumed" if getattr(ssl_object, "session_reused", False)
+                         else "full handshake")
+        return reader, writer
+
+    @staticmethod
+    def create_tls_context(verify=True, cafile=None, certfile=None, keyfile=None):
+        context = ResumingSSLContext(getattr(ssl, "PROTOCOL_TLS_CLIENT", ssl.PROTOCOL_SSLv23))
+        context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+        if verify:
+            context.verify_mode = ssl.CERT_REQUIRED
+            context.check_hostname = True
+            if cafile is not None:
+                context.load_verify_locations(cafile)
+            else:
+                context.load_default_certs()
+        else:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        if certfile is not None:
+            context.load_cert_chain(certfile, keyfile)
+        return context
+
+    @asyncio.coroutine
+    def _connect_socket(self, family, type, proto, _canonname, address):
+        sock = socket.socket(family, type, proto)
+        try:
+            sock.setblocking(False)
+            yield from self.loop.sock_connect(sock, address)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
     @asyncio.coroutine
     def read(self):
         while True:
@@ -179,6 +489,11 @@ class Server:
 
             self.logger.debug("<< %s", text)
 
+            tags = {}
+            if text.startswith("@"):
+                rawtags, text = text[1:].split(' ', 1)
+                tags = parse_tags(rawtags)
+
             if text.startswith(":"):
                 username, msgtype, *parameters = text[1:].split(' ') #remove starting :
                 try:
@@ -202,6 +517,14 @@ class Server:
                 else:
                     user = User(username, self, access, ident, host)
 
+                account_changed = False
+                if host is not None and "account-tag" in self.capabilities:
+                    # messages from logged in users carry their account
+                    account = tags.get("account")
+                    account_changed = (account is not None and account != user.account and
+                                       username in self.users)
+                    user.account = account
+
                 for i, v in enumerate(parameters):
                     if v.startswith(":"):
                         #remove the : and join together all succeeding parameters
@@ -216,10 +539,15 @@ class Server:
 
                 if could_parse_message:
                     self.run_callbacks(msgtype, user, *parameters)
+                if account_changed:
+                    self.run_callbacks(Server.account_known_event, user)
             else:
                 self.logger.info("Server sent: %s", text)
                 if text.startswith("PING"):
                     self.write("PONG " + text.split(' ')[1])
+                elif text == "AUTHENTICATE +" and self.sasl_external:
+                    # the certificate is the credential, so the response is empty
+                    self.write("AUTHENTICATE +")
 
         self.logger.warning("Aborted reading from server")
         self.reset_connection()
@@ -227,24 +555,177 @@ class Server:
     def on_welcome(self, host):
         self.host = host
         self.welcomed = True
-
-        # perform autojoins
+        self.failed_attempts = 0
+
+        # with TLS 1.3 the session ticket only arrives after the handshake, so wait until
+        # now to remember the session for the next connection
+        if self.tls_context is not None:
+            ssl_object = self.writer.get_extra_info("ssl_object")
+            session = getattr(ssl_object, "session", None)
+            if session is not None:
+                self.tls_context.remember_session(self.addresses[self.address_index][0], session)
+
+        # perform autojoins, and rejoin the channels the bot was in before reconnecting
+        channels = CaseInsensitiveDict(self.casemapping)
         for channel in self.autojoin:
+            channels[channel] = channel
+        if self.snapshot is not None:
+            for channel in self.snapshot.channels.values():
+                channels.setdefault(channel.channelname, channel.channelname)
+            self._rejoin_handle = self.loop.call_later(self.rejoin_timeout, self.expire_snapshot)
+        for channel in channels.values():
             self.join(channel)
 
         self._keepalive_handler = self.loop.call_later(self.keepalive_interval, self.keepalive)
 
+    def discard_snapshot_channel(self, channelname):
+        """Forgets the state of channelname from before the last disconnect"""
+        if self.snapshot is None:
+            return
+        self.snapshot.discard_channel(channelname)
+        if len(self.snapshot.channels) == 0:
+            self.snapshot = None
+            if self._rejoin_handle is not None:
+                self._rejoin_handle.cancel()
+                self._rejoin_handle = None
+
+    def expire_snapshot(self):
+        """Forgets the channels from before the last disconnect that haven't been rejoined"""
+        self._rejoin_handle = None
+        if self.snapshot is None:
+            return
+        for channel in list(self.snapshot.channels.values()):
+            if channel.channelname not in self.channels:
+                self.logger.info("Couldn't rejoin %s, forgetting it", channel.channelname)
+                self.discard_snapshot_channel(channel.channelname)
+
     def keepalive(self):
         if self.host is not None:
-            self.write("PING :{}".format(self.host), log=False)
+            self.send_ping()
 
         self._keepalive_handler = self.loop.call_later(self.keepalive_interval, self.keepalive)
 
+    def fold(self, name):
+        """Returns name casefolded according to the server's CASEMAPPING"""
+        return irc_lower(name, self.casemapping)
+
+    def set_casemapping(self, casemapping):
+        """Switches to a new CASEMAPPING, rebuilding the name indexes"""
+        self.casemapping = casemapping
+        channels, users = list(self.channels.values()), list(self.users.values())
+        self.channels = CaseInsensitiveDict(casemapping)
+        self.users = CaseInsensitiveDict(casemapping)
+        self.accounts = CaseInsensitiveDict(casemapping)
+        self.account_cache = {}
+        for channel in channels:
+            self.channels[channel.channelname] = channel
+        for user in users:
+            self.add_user(user)
+
+    def send_ping(self):
+        # written directly rather than queued, so that the throttle doesn't count as lag
+        token = "waterbug{}".format(next(self.ping_tokens))
+        self.last_ping = self.pings[token] = self.loop.time()
+        self.writer.write("PING :{}\r\n".format(token).encode(self.outencoding))
+
+    def record_pong(self, token):
+        if token not in self.pings:
+            return
+        # pings are answered in order, so any earlier ones were lost
+        while True:
+            sent_token, sent = self.pings.popitem(last=False)
+            if sent_token == token:
+                break
+
+        self.last_lag = self.loop.time() - sent
+        self.lag = self.last_lag if self.lag is None else 0.75 * self.lag + 0.25 * self.last_lag
+        self.min_lag = self.last_lag if self.min_lag is None else min(self.min_lag, self.last_lag)
+
+    def current_lag(self):
+        """Returns the estimated round-trip time to the server in seconds, or None if unknown
+
+        A ping that has been waiting for its answer longer than the average counts as well, so
+        that a growing lag is noticed before the answer arrives.
+        """
+        lag = self.lag
+        if len(self.pings) > 0:
+            waited = self.loop.time() - next(iter(self.pings.values()))
+            lag = waited if lag is None else max(lag, waited)
+        return lag
+
+    def write_delay(self):
+        """Returns how long to wait between lines, backing off as the lag grows
+
+        Lag beyond the lowest measured one is taken to mean that the server's queue for the
+        connection is filling up, and is added to the throttle.
+        """
+        lag = self.current_lag()
+        if lag is None or self.min_lag is None:
+            return self.throttle
+        return min(self.throttle + max(lag - self.min_lag, 0), self.max_throttle)
+
+    def tracks_account(self, user):
+        """Returns whether user.account is kept up to date by the server without a WHO"""
+        if "account-tag" in self.capabilities:
+            return True
+        return ("account-notify" in self.capabilities and
+                "extended-join" in self.capabilities and
+                self.users.get(user.username) is user)
+
+    def users_by_account(self, account):
+        """Returns the known users that are logged in as account"""
+        if account in self.accounts:
+            return frozenset(self.accounts[account])
+        else:
+            return frozenset()
+
+    def add_user(self, user):
+        self.users[user.username] = user
+        if user.account is not None:
+            if user.account not in self.accounts:
+                self.accounts[user.account] = set()
+            self.accounts[user.account].add(user)
+
+    def remove_user(self, user):
+        del self.users[user.username]
+        if user.account is not None:
+            users = self.accounts[user.account]
+            users.discard(user)
+            if len(users) == 0:
+                del self.accounts[user.account]
+
     def msg(self, target, message):
-        self.write("PRIVMSG {} :{}".format(target, message))
+        self.send_to("PRIVMSG", target, message)
 
     def notice(self, target, message):
-        self.write("NOTICE {} :{}".format(target, message))
+        self.send_to("NOTICE", target, message)
+
+    def send_to(self, command, target, message):
+        """Queues command to target, sharing a line with the same message to other targets
+
+        A message is only added to an already queued one if the server accepts that many
+        targets according to TARGMAX, the line stays short enough not to be cut off, and no
+        other message to the target has been queued after it.
+        """
+        key = command, message
+        queued = self.multi_target_messages.get(key)
+        if queued is not None:
+            limit = self.max_targets(command)
+            targets = queued.targets + [target]
+            if ((limit is None or len(targets) <= limit) and
+                    self.last_queued.get(self.fold(target), -1) < queued.position and
+                    len(queued.format(targets)) <= self.max_line_length()):
+                queued.targets.append(target)
+                self.last_queued[self.fold(target)] = queued.position
+                return
+
+        queued = MultiTargetMessage(command, [target], message, next(self.queue_position))
+        self.multi_target_messages[key] = queued
+        self.last_queued[self.fold(target)] = queued.position
+        self.message_queue.put_nowait((queued, True))
+
+    def max_line_length(self):
+        return self.supported.get('TOPICLEN', 300)
 
     def join(self, channel):
         self.write("JOIN {}".format(channel))
@@ -265,30 +746,144 @@ class Server:
         self.reconnect = False
 
     def who(self, mask, extended=True):
+        """Sends a WHO, returning a future for the WhoRequest which is set at its 315"""
+        request = WhoRequest(mask, next(self.who_tokens) if extended else None, self.loop)
+        self.pending_who.setdefault(self.fold(mask), collections.deque()).append(request)
         if extended:
-            self.write("WHO {} %uhnfar".format(mask))
+            self.who_requests[request.token] = request
+            self.write("WHO {} %tuhnfar,{}".format(mask, request.token))
         else:
             self.write("WHO {}".format(mask))
+        return request.future
+
+    @asyncio.coroutine
+    def lookup_account(self, user):
+        """Returns the account user is logged in as, or None
+
+        Accounts are cached for account_cache_ttl seconds, but only used for a user with the same
+        nick!ident@host, since the bot doesn't see the nick changes and quits of users it
+        doesn't share a channel with. Concurrent lookups of the same user share a single WHO.
+        """
+        key = self.fold(user.username)
+        if key in self.account_cache:
+            account, ident, host, expires = self.account_cache[key]
+            if (expires > self.loop.time() and user.ident is not None and
+                    (ident, host) == (user.ident, user.hostname)):
+                return account
+
+        key = key, user.ident, user.hostname
+        if key not in self.account_lookups:
+            self.account_lookups[key] = asyncio.async(self._lookup_account(user, key),
+                                                      loop=self.loop)
+        return (yield from asyncio.shield(self.account_lookups[key], loop=self.loop))
+
+    @asyncio.coroutine
+    def _lookup_account(self, user, key):
+        try:
+            request = yield from asyncio.wait_for(self.who(user.username), 10, loop=self.loop)
+            nick = self.fold(user.username)
+            # someone else may have taken the nick in the meantime
+            if nick not in request.accounts or request.hosts[nick] != (user.ident, user.hostname):
+                return None
+            return request.accounts[nick]
+        finally:
+            del self.account_lookups[key]
+
+    def queue_who(self, nick, channel):
+        """Looks up a user who joined channel, batched with other joins over who_delay seconds"""
+        self.who_queue.setdefault(self.fold(channel), collections.OrderedDict())[self.fold(nick)] = nick
+        if self._who_handle is None:
+            self._who_handle = self.loop.call_later(self.who_delay, self.flush_who)
+
+    def flush_who(self):
+        self._who_handle = None
+        queue, self.who_queue = self.who_queue, collections.OrderedDict()
+
+        nicks = collections.OrderedDict()
+        covered = set()
+        for channel, pending in queue.items():
+            if channel not in self.channels:
+                continue
+            channel = self.channels[channel]
+            pending = [nick for nick in pending.values() if nick in self.users]
+            # after a netsplit most of a channel rejoins at once, and then a single WHO for
+            # the whole channel is cheaper than asking for each user
+            if len(pending) > 1 and len(pending) * 2 >= len(channel.users):
+                self.who(channel.channelname)
+                covered.update(self.fold(nick) for nick in pending)
+            else:
+                nicks.update((self.fold(nick), nick) for nick in pending)
+
+        # ask for as many nicks per line as the server allows
+        targets = self.max_targets("WHO") or len(nicks)
+        batch = []
+        for key, nick in nicks.items():
+            if key in covered:
+                continue
+            if len(batch) >= targets or sum(len(n) + 1 for n in batch) + len(nick) > 400:
+                self.who(",".join(batch))
+                batch = []
+            batch.append(nick)
+        if len(batch) > 0:
+            self.who(",".join(batch))
+
+    def max_targets(self, command):
+        """Returns how many targets command accepts according to TARGMAX, or None if unlimited"""
+        targmax = self.supported.get("TARGMAX")
+        if isinstance(targmax, str):
+            for entry in targmax.split(","):
+                name, _, limit = entry.partition(":")
+                if name.upper() == command.upper():
+                    return int(limit) if limit else None
+        # older servers give a single limit for messages
+        if command.upper() in ("PRIVMSG", "NOTICE") and "MAXTARGETS" in self.supported:
+            return int(self.supported["MAXTARGETS"])
+        return 1
+
+    def cache_account(self, nick, ident, host, account):
+        # a user who isn't logged in may identify at any moment, so only accounts are cached
+        if account is None:
+            self.account_cache.pop(self.fold(nick), None)
+        elif ident is not None and host is not None:
+            self.account_cache[self.fold(nick)] = (account, ident, host,
+                                                   self.loop.time() + self.account_cache_ttl)
 
     def write(self, line, log=True):
+        self.message_queue.put_nowait((self.sanitize(line), log))
+
+    def sanitize(self, line):
         # replace control characters
         line = "".join("[{}]".format(ord(x)) if ord(x) < 0x20 else x for x in line)
 
-        maxlength = self.supported.get('TOPICLEN', 300)
+        maxlength = self.max_line_length()
         if len(line) > maxlength:
             line = "{} {}".format(line[:maxlength], "<...>")
-
-        self.message_queue.put_nowait((line, log))
+        return line
 
     @asyncio.coroutine
     def handle_write(self):
         try:
             while True:
                 line, log = yield from self.message_queue.get()
+                if isinstance(line, MultiTargetMessage):
+                    # no more targets can be added once the message is on its way
+                    queued = line
+                    key = queued.command, queued.message
+                    if self.multi_target_messages.get(key) is queued:
+                        del self.multi_target_messages[key]
+                    for target in queued.targets:
+                        if self.last_queued.get(self.fold(target)) == queued.position:
+                            del self.last_queued[self.fold(target)]
+                    line = self.sanitize(queued.format(queued.targets))
                 if log:
                     self.logger.info(">> %s", line)
                 self.writer.write(line.encode(self.outencoding) + b'\r\n')
-                yield from asyncio.sleep(self.throttle)
+
+                # measure the lag more often while there is a lot to send
+                if (not self.message_queue.empty() and len(self.pings) == 0 and
+                        self.loop.time() - (self.last_ping or 0) > self.lag_probe_interval):
+                    self.send_ping()
+                yield from asyncio.sleep(self.write_delay())
         except asyncio.CancelledError:
             pass
 
@@ -303,14 +898,26 @@ class Server:
         def NOTICE(self, sender, target, message):
             self.server.logger.info("[NOTICE] <%s to %s> %s", sender, target, message)
 
-        def JOIN(self, sender, channel):
+        def JOIN(self, sender, channel, account=None, realname=None):
             self.server.logger.info("%s joined channel %s", sender, channel)
 
+            # extended-join
+            if account is not None:
+                sender.account = account if account != '*' else None
+                sender.realname = realname
+
             if sender is self.server.ownuser:
-                self.server.channels[channel] = Channel(channel)
-                self.server.who(channel)
-            else:
-                self.server.who(sender.username)
+                self.server.channels[channel] = Channel(channel, self.server)
+                snapshot = self.server.snapshot
+                if snapshot is not None and channel in snapshot.channels:
+                    # decide which users to look up once NAMES has been received
+                    self.server.names_refresh[self.server.fold(channel)] = []
+                else:
+                    self.server.who(channel)
+            elif not ("extended-join" in self.server.capabilities and
+                      "account-notify" in self.server.capabilities):
+                # with both capabilities the join itself carries everything a WHO would tell
+                self.server.queue_who(sender.username, channel)
 
             sender.add_channel(self.server.channels[channel])
 
@@ -326,14 +933,62 @@ class Server:
         def QUIT(self, sender, message=""):
             self.server.logger.info("User %s quit with message %s", sender, message)
 
-            for channel in sender.knownchannels.values():
-                del channel.users[sender.username]
-
-            del self.server.users[sender.username]
+            self.server.memberships.remove_user(sender)
+            self.server.remove_user(sender)
+            self.server.account_cache.pop(self.server.fold(sender.username), None)
+
+        def ACCOUNT(self, sender, account):
+            self.server.logger.info("User %s is now %s", sender,
+                                    "logged in as {}".format(account) if account != '*'
+                                    else "logged out")
+
+            sender.account = account if account != '*' else None
+            self.server.cache_account(sender.username, sender.ident, sender.hostname,
+                                      sender.account)
+
+        def AWAY(self, sender, message=None):
+            sender.away = message is not None
+
+        def CAP(self, sender, target, subcommand, *args):
+            self.server.logger.info("[CAP] %s %s", subcommand, " ".join(args))
+            capabilities = args[-1].split() if len(args) > 0 else []
+
+            if subcommand == "LS":
+                self.server.available_capabilities.update(
+                    capability.split("=", 1)[0] for capability in capabilities)
+                # a '*' before the list means that more lines will follow
+                if len(args) == 1:
+                    wanted = self.server.wanted_capabilities
+                    if self.server.sasl_external:
+                        wanted = wanted | {"sasl"}
+                    wanted = wanted & self.server.available_capabilities
+                    if len(wanted) > 0:
+                        self.server.write("CAP REQ :{}".format(" ".join(sorted(wanted))))
+                    else:
+                        self.server.write("CAP END")
+            elif subcommand == "ACK":
+                for capability in capabilities:
+                    if capability.startswith("-"):
+                        self.server.capabilities.discard(capability[1:])
+                    else:
+                        self.server.capabilities.add(capability.lstrip("~="))
+                if (self.server.sasl_external and not self.server.welcomed and
+                        "sasl" in capabilities):
+                    # registration continues once SASL has finished
+                    self.server.write("AUTHENTICATE EXTERNAL")
+                elif not self.server.welcomed:
+                    self.server.write("CAP END")
+            elif subcommand == "NAK":
+                if not self.server.welcomed:
+                    self.server.write("CAP END")
+            elif subcommand == "DEL":
+                self.server.capabilities.difference_update(capabilities)
 
         def NICK(self, sender, message):
             self.server.logger.info("User %s changed nick to %s", sender, message)
 
+            self.server.account_cache.pop(self.server.fold(sender.username), None)
+            self.server.account_cache.pop(self.server.fold(message), None)
             sender.rename(message)
 
         def TOPIC(self, sender, channel, topic):
@@ -346,12 +1001,12 @@ class Server:
 
         def PONG(self, sender, host, message):
             #self.server.logger.info("[PONG] %s", message)
-            pass
+            self.server.record_pong(message)
 
         def _001(self, sender, user, message):
             self.server.logger.info("[Welcome] %s", message)
             self.server.ownuser = User(user, self.server)
-            self.server.users[user] = self.server.ownuser
+            self.server.add_user(self.server.ownuser)
 
             self.server.on_welcome(sender)
 
@@ -381,6 +1036,10 @@ class Server:
                 else:
                     self.server.supported[a[0]] = True
 
+            casemapping = self.server.supported.get("CASEMAPPING", self.server.casemapping)
+            if casemapping != self.server.casemapping:
+                self.server.set_casemapping(casemapping)
+
         def _250(self, sender, user, message):
             self.server.logger.info("[Statistics] %s", message)
 
@@ -408,6 +1067,15 @@ class Server:
         def _315(self, sender, target, channel, info):
             self.server.logger.info("[End of WHO to %s] %s", channel, info)
 
+            requests = self.server.pending_who.get(self.server.fold(channel))
+            if requests:
+                request = requests.popleft()
+                if len(requests) == 0:
+                    del self.server.pending_who[self.server.fold(channel)]
+                self.server.who_requests.pop(request.token, None)
+                if not request.future.done():
+                    request.future.set_result(request)
+
         def _332(self, sender, target, channel, topic):
             self.server.logger.info("Topic of %s is %s", channel, topic)
             self.server.channels[channel].topic = topic
@@ -433,33 +1101,82 @@ class Server:
             users = users_on_channel.split(' ')
             self.server.logger.info("Users currently in %s: %s", channel, users)
 
+            prefixes = self.server.supported["PREFIX"].split(")")[-1]
+            refresh = self.server.names_refresh.get(self.server.fold(channel))
             for username in users:
-                if username[0] in self.server.supported["PREFIX"]:
-                    username = username[1:]
+                # with multi-prefix, there may be several prefixes, and with
+                # userhost-in-names the nick is followed by !ident@host
+                username, _, host = username.lstrip(prefixes).partition("!")
+                ident, _, host = host.rpartition("@")
 
                 if username in self.server.users:
                     user = self.server.users[username]
+                elif refresh is not None:
+                    user = self.server.snapshot.restore(channel, username, ident, host)
+                    if user is None:
+                        user = User(username, self.server, ident=ident or None,
+                                    hostname=host or None)
+                        refresh.append(username)
                 else:
-                    user = User(username, self.server)
+                    user = User(username, self.server, ident=ident or None, hostname=host or None)
 
                 user.add_channel(self.server.channels[channel])
 
-        def _354(self, sender, target, ident, host, nick, heregone, account, realname):
-            user = self.server.users[nick]
-            user.ident = ident
-            user.hostname = host
-            user.realname = realname
-            user.away = heregone == 'G'
-            user.account = account if account != '0' else None
+        def _354(self, sender, target, *fields):
+            if len(fields) == 7:
+                token, ident, host, nick, heregone, account, realname = fields
+            else:
+                token = None
+                ident, host, nick, heregone, account, realname = fields
+            account = account if account != '0' else None
             self.server.logger.info("[Whox] %s%s is %s@%s (%s) and %s",
-                                    nick, " (away)" if user.away else "",
-                                    user.ident, user.hostname, user.realname,
-                                    "logged in as {}".format(user.account)
-                                    if user.account is not None else "not logged in")
+                                    nick, " (away)" if heregone[0] == 'G' else "",
+                                    ident, host, realname,
+                                    "logged in as {}".format(account)
+                                    if account is not None else "not logged in")
+
+            self.server.cache_account(nick, ident, host, account)
+            if token is not None and int(token) in self.server.who_requests:
+                request = self.server.who_requests[int(token)]
+                request.accounts[self.server.fold(nick)] = account
+                request.realnames[self.server.fold(nick)] = realname
+                request.hosts[self.server.fold(nick)] = ident, host
+
+            if nick in self.server.users:
+                user = self.server.users[nick]
+                user.ident = ident
+                user.hostname = host
+                user.realname = realname
+                user.away = heregone[0] == 'G'
+                user.account = account
 
         def _366(self, sender, target, channel, message):
             self.server.logger.info("End of NAMES")
 
+            refresh = self.server.names_refresh.pop(self.server.fold(channel), None)
+            if refresh is not None:
+                self.server.logger.info("Rejoined %s, looking up %d of %d users", channel,
+                                        len(refresh), len(self.server.channels[channel].users))
+                for nick in refresh:
+                    self.server.queue_who(nick, channel)
+
+                # the restored users are back without any JOIN, WHO reply or ACCOUNT
+                refreshed = {self.server.fold(nick) for nick in refresh}
+                for user in self.server.channels[channel].users.values():
+                    if (user.account is not None and user is not self.server.ownuser and
+                            self.server.fold(user.username) not in refreshed):
+                        self.server.run_callbacks(Server.account_known_event, user)
+
+                self.server.discard_snapshot_channel(channel)
+
+        def _471(self, sender, target, channel, message):
+            # the channel is full, invite only, banned or keyed, so don't try to rejoin it on
+            # every reconnect
+            self.server.logger.info("Couldn't join %s: %s", channel, message)
+            self.server.discard_snapshot_channel(channel)
+
+        _473 = _474 = _475 = _471
+
         def _372(self, sender, target, message):
             self.server.logger.info("[MOTD] %s", message)
 
@@ -481,6 +1198,21 @@ class Server:
                     self.server.username = self.server.original_username + "1"
                 self.server.nick(self.server.username)
 
+        def _900(self, sender, target, mask, account, message):
+            self.server.logger.info("[SASL] %s", message)
+
+        def _903(self, sender, target, message):
+            self.server.logger.info("[SASL] %s", message)
+            if not self.server.welcomed:
+                self.server.write("CAP END")
+
+        def _904(self, sender, target, message):
+            self.server.logger.warning("[SASL] %s", message)
+            if not self.server.welcomed:
+                self.server.write("CAP END")
+
+        _905 = _906 = _907 = _904
+
         def _default(self, msgtype, sender, *message):
             self.server.logger.info("Unsupported message %s sent by user %s: %s", msgtype, sender, message)
 
@@ -497,86 +1229,348 @@ class Server:
 
 
 
+class MultiTargetMessage:
+
+    __slots__ = ['command', 'targets', 'message', 'position']
+
+    def __init__(self, command, targets, message, position):
+        self.command = command
+        self.targets = targets
+        self.message = message
+        self.position = position
+
+    def format(self, targets):
+        return "{} {} :{}".format(self.command, ",".join(targets), self.message)
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """SSL context which resumes the last TLS session with a host, where supported
+
+    asyncio has no way to pass a session along, so it's added when the connection is wrapped.
+    """
+
+    def remember_session(self, host, session):
+        if not hasattr(self, "sessions"):
+            self.sessions = {}
+        self.sessions[host] = session
+
+    def _add_session(self, kwargs):
+        session = getattr(self, "sessions", {}).get(kwargs.get("server_hostname"))
+        if session is not None:
+            kwargs.setdefault("session", session)
+
+    def wrap_socket(self, *args, **kwargs):
+        self._add_session(kwargs)
+        return super().wrap_socket(*args, **kwargs)
+
+    def wrap_bio(self, *args, **kwargs):
+        self._add_session(kwargs)
+        return super().wrap_bio(*args, **kwargs)
+
+
+class StateSnapshot:
+    """The channels and users known to a server when its connection was lost"""
+
+    def __init__(self, server, previous=None):
+        self.channels = server.channels
+        self.users = server.users
+        self.members = {channel: server.memberships.users_of(channel)
+                        for channel in server.channels.values()}
+
+        # channels that hadn't been rejoined yet since the previous disconnect
+        if previous is not None:
+            for channel in previous.channels.values():
+                if channel.channelname not in self.channels:
+                    self.channels[channel.channelname] = channel
+                    self.members[channel] = previous.members[channel]
+            for user in previous.users.values():
+                self.users.setdefault(user.username, user)
+
+    def restore(self, channelname, nick, ident, host):
+        """Returns the user nick!ident@host if it was on the channel and seems unchanged"""
+        channel = self.channels.get(channelname)
+        user = self.users.get(nick)
+        if channel is None or user is None or user not in self.members[channel]:
+            return None
+        # without userhost-in-names there is no telling whether it's still the same user
+        if not ident or not host or (user.ident, user.hostname) != (ident, host):
+            return None
+        user.server.add_user(user)
+        return user
+
+    def discard_channel(self, channelname):
+        channel = self.channels.pop(channelname, None)
+        self.members.pop(channel, None)
+
+
+class WhoRequest:
+
+    def __init__(self, mask, token, loop):
+        self.mask = mask
+        self.token = token
+        self.future = asyncio.Future(loop=loop)
+        # casefolded nick -> account, realname or (ident, host), from the WHOX replies
+        self.accounts = {}
+        self.realnames = {}
+        self.hosts = {}
+
+
+def parse_tags(rawtags):
+    escapes = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+    tags = {}
+    for tag in rawtags.split(";"):
+        key, _, value = tag.partition("=")
+        tags[key] = re.sub(r"\\(.?)", lambda m: escapes.get(m.group(1), m.group(1)), value)
+    return tags
+
+
 class Channel:
 
-    def __init__(self, channelname):
+    __slots__ = ['channelname', 'server', 'topic', 'topicchanged', 'topicchanger', 'modes']
+
+    def __init__(self, channelname, server):
         self.channelname = channelname
-        self.users = CaseInsensitiveDict()
+        self.server = server
         self.topic = None
         self.topicchanged = None
         self.topicchanger = None
         self.modes = set()
 
+    @property
+    def users(self):
+        return MembershipView(self.server.memberships.users_of(self), self.server.users)
+
     def __repr__(self):
         return self.channelname
 
 class User:
 
+    __slots__ = ['_account', '_ident', '_hostname', 'username', 'access', 'server', 'realname',
+                 'idletime', 'onlinetime', 'away', 'usermodes']
+
     def __init__(self, username, server, access=1, ident=None, hostname=None):
+        self._account = None
         self.username = username
         self.access = access
         self.ident = ident
         self.hostname = hostname
         self.server = server
-        self.knownchannels = CaseInsensitiveDict()
         self.realname = None
         self.idletime = None
         self.onlinetime = None
-        self.account = None
         self.away = None
-        self.usermodes = set()
+        self.usermodes = frozenset()
+
+    # most users share their ident and host with many others, so keep a single copy of each
+    @property
+    def ident(self):
+        return self._ident
+
+    @ident.setter
+    def ident(self, ident):
+        self._ident = sys.intern(ident) if ident is not None else None
+
+    @property
+    def hostname(self):
+        return self._hostname
+
+    @hostname.setter
+    def hostname(self, hostname):
+        self._hostname = sys.intern(hostname) if hostname is not None else None
+
+    @property
+    def knownchannels(self):
+        return MembershipView(self.server.memberships.channels_of(self), self.server.channels)
+
+    @property
+    def account(self):
+        return self._account
+
+    @account.setter
+    def account(self, account):
+        # keep the server's account index up to date for users it knows about
+        registered = self.server.users.get(self.username) is self
+        if registered:
+            self.server.remove_user(self)
+        self._account = account
+        if registered:
+            self.server.add_user(self)
 
     def add_channel(self, channel):
         if self.username not in self.server.users:
-            self.server.users[self.username] = self
+            self.server.add_user(self)
 
-        self.knownchannels[channel.channelname] = channel
-        channel.users[self.username] = self
+        self.server.memberships.add(channel, self)
 
     def remove_channel(self, channel):
-
-        del self.knownchannels[channel.channelname]
-        del channel.users[self.username]
+        memberships = self.server.memberships
+        memberships.discard(channel, self)
 
         if self is self.server.ownuser:
-            for user in list(channel.users.values()):
-                if user is not self:
-                    user.remove_channel(channel)
+            for user in memberships.remove_channel(channel):
+                if len(memberships.channels_of(user)) == 0:
+                    self.server.remove_user(user)
             del self.server.channels[channel.channelname]
         else:
-            if len(self.knownchannels) == 0:
-                del self.server.users[self.username]
+            if len(memberships.channels_of(self)) == 0:
+                self.server.remove_user(self)
 
     def rename(self, newnick):
-        del self.server.users[self.username]
-        for channel in self.knownchannels.values():
-            del channel.users[self.username]
-
+        # memberships refer to the user itself, so only the name index has to change
+        registered = self.server.users.get(self.username) is self
+        if registered:
+            self.server.remove_user(self)
         self.username = newnick
-
-        self.server.users[self.username] = self
-        for channel in self.knownchannels.values():
-            channel.users[self.username] = self
+        if registered:
+            self.server.add_user(self)
 
     def __repr__(self):
         return self.username
 
 
+class Memberships:
+    """Which users are on which channels, for all channels of a server"""
+
+    __slots__ = ['_users', '_channels']
+
+    def __init__(self):
+        self._users = {}
+        self._channels = {}
+
+    def add(self, channel, user):
+        self._users.setdefault(channel, set()).add(user)
+        self._channels.setdefault(user, set()).add(channel)
+
+    def discard(self, channel, user):
+        Memberships._discard(self._users, channel, user)
+        Memberships._discard(self._channels, user, channel)
+
+    @staticmethod
+    def _discard(index, key, value):
+        values = index.get(key)
+        if values is not None:
+            values.discard(value)
+            if len(values) == 0:
+                del index[key]
+
+    def users_of(self, channel):
+        return self._users.get(channel, frozenset())
+
+    def channels_of(self, user):
+        return self._channels.get(user, frozenset())
+
+    def remove_user(self, user):
+        """Removes user from all channels, returning them"""
+        channels = self._channels.pop(user, frozenset())
+        for channel in channels:
+            Memberships._discard(self._users, channel, user)
+        return channels
+
+    def remove_channel(self, channel):
+        """Removes all users from channel, returning them"""
+        users = self._users.pop(channel, frozenset())
+        for user in users:
+            Memberships._discard(self._channels, user, channel)
+        return users
+
+
+class MembershipView(collections.abc.Mapping):
+    """Read-only mapping from names to the channels or users in members"""
+
+    __slots__ = ['_members', '_index']
+
+    def __init__(self, members, index):
+        self._members = members
+        self._index = index
+
+    def __getitem__(self, name):
+        member = self._index[name]
+        if member not in self._members:
+            raise KeyError(name)
+        return member
+
+    def __contains__(self, name):
+        return self._index.get(name) in self._members
+
+    def __iter__(self):
+        return (repr(member) for member in self._members)
+
+    def __len__(self):
+        return len(self._members)
+
+    def values(self):
+        return list(self._members)
+
+
+# translation tables for the CASEMAPPING values of 005
+casemappings = {
+    "ascii": str.maketrans(string.ascii_uppercase, string.ascii_lowercase),
+    "rfc1459": str.maketrans(string.ascii_uppercase + "[]\\~", string.ascii_lowercase + "{}|^"),
+    "strict-rfc1459": str.maketrans(string.ascii_uppercase + "[]\\", string.ascii_lowercase + "{}|")
+}
+
+@functools.lru_cache(maxsize=65536)
+def irc_lower(name, casemapping="rfc1459"):
+    if casemapping in casemappings:
+        return name.translate(casemappings[casemapping])
+    else:
+        # e.g. rfc7613, which folds unicode as well
+        return name.lower()
+
+
 class CaseInsensitiveDict(dict):
-        def __setitem__(self, key, value):
-            super().__setitem__(key.lower(), value)
 
-        def __getitem__(self, key):
-            return super().__getitem__(key.lower())
+    __slots__ = ['casemapping']
+
+    def __init__(self, casemapping="rfc1459"):
+        super().__init__()
+        self.casemapping = casemapping
+
+    def __setitem__(self, key, value):
+        super().__setitem__(irc_lower(key, self.casemapping), value)
+
+    def __getitem__(self, key):
+        return super().__getitem__(irc_lower(key, self.casemapping))
 
-        def __contains__(self, key):
-            return super().__contains__(key.lower())
+    def __contains__(self, key):
+        return super().__contains__(irc_lower(key, self.casemapping))
 
-        def __delitem__(self, key):
-            super().__delitem__(key.lower())
+    def __delitem__(self, key):
+        super().__delitem__(irc_lower(key, self.casemapping))
+
+    def get(self, key, default=None):
+        return super().get(irc_lower(key, self.casemapping), default)
+
+    def setdefault(self, key, default=None):
+        return super().setdefault(irc_lower(key, self.casemapping), default)
+
+    def pop(self, key, *default):
+        return super().pop(irc_lower(key, self.casemapping), *default)
 
 
 @asyncio.coroutine
-def fetch_url(url, *, method="GET", timeout=10, **kwargs):
+def fetch_url(url, *, method="GET", timeout=10, return_headers=False, **kwargs):
     res = yield from asyncio.wait_for(aiohttp.request(method, url, **kwargs), timeout)
-    return (yield from res.read_and_close())
+    body = yield from res.read_and_close()
+    if return_headers:
+        return body, res.headers
+    else:
+        return body
+
+def cache_lifetime(headers):
+    """Returns for how many seconds a response may be cached, or None if the headers don't say"""
+    match = re.search(r"max-age=(\d+)", headers.get("Cache-Control", ""))
+    if match is not None:
+        try:
+            age = int(headers.get("Age", 0))
+        except ValueError:
+            age = 0
+        return max(int(match.group(1)) - age, 0)
+
+    expires = email.utils.parsedate_tz(headers.get("Expires", ""))
+    if expires is not None:
+        date = email.utils.parsedate_tz(headers.get("Date", ""))
+        now = email.utils.mktime_tz(date) if date is not None else time.time()
+        return max(email.utils.mktime_tz(expires) - now, 0)
+
+    return None
@@ -0,0 +1,324 @@
+#   Waterbug, a modular IRC bot written using Python 3
+#   Copyright (C) 2011  Arvid Fahlström Myrman
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['Scheduler', 'Job', 'CronExpression', 'PollResult']
+
+import asyncio
+import collections
+import datetime
+import heapq
+import itertools
+import logging
+import math
+import random
+import time
+
+
+PollResult = collections.namedtuple('PollResult', ['changed', 'cache_lifetime'])
+
+
+class CronExpression:
+    """Five-field cron expression: minute, hour, day of month, month and day of week"""
+
+    fields = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+    # the longest each month can be, counting leap years
+    month_days = [31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+
+    def __init__(self, expression):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError("Expected five fields in cron expression '{}'".format(expression))
+
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            CronExpression._parse(part, low, high)
+            for part, (low, high) in zip(parts, CronExpression.fields))
+        # both 0 and 7 mean sunday
+        self.weekdays = frozenset(day % 7 for day in weekdays)
+        self.any_day = parts[2] == '*'
+        self.any_weekday = parts[4] == '*'
+
+        # unless the weekday can match instead, a day like the 31st of april never comes
+        if self.any_weekday and min(self.days) > max(CronExpression.month_days[month - 1]
+                                                     for month in self.months):
+            raise ValueError("Cron expression '{}' never matches".format(expression))
+
+    @staticmethod
+    def _parse(part, low, high):
+        values = set()
+        for item in part.split(','):
+            span, _, step = item.partition('/')
+            step = int(step) if step else 1
+            if span == '*':
+                start, end = low, high
+            elif '-' in span:
+                start, end = map(int, span.split('-', 1))
+            else:
+                start = int(span)
+                end = high if step > 1 else start
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError("Invalid cron field '{}'".format(part))
+            values.update(range(start, end + 1, step))
+        return frozenset(values)
+
+    def _day_matches(self, date):
+        day = date.day in self.days
+        weekday = (date.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        # when both are restricted, matching either one is enough
+        return day or weekday
+
+    def next_after(self, after):
+        """Returns the first matching minute after the given naive local datetime"""
+        t = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = t + datetime.timedelta(days=5*366)
+        while t < limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1) + datetime.timedelta(days=32)).replace(
+                    day=1, hour=0, minute=0)
+            elif not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + datetime.timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += datetime.timedelta(minutes=1)
+            else:
+                return t
+        raise ValueError("Cron expression '{}' never matches".format(self.expression))
+
+    def __repr__(self):
+        return self.expression
+
+
+class Job:
+    """A callback run by a Scheduler
+
+    With fixed_rate the runs are spaced seconds apart from the time they were due, otherwise
+    the next run is due seconds after the previous one finished. If cron is given it is used
+    instead of seconds. A random delay of up to jitter seconds is added to every run, and if
+    skip_if_running is set a run that is due while the previous one is still running is
+    skipped.
+
+    An adaptive job has its interval adjusted between min_seconds and max_seconds (by
+    default a fourth of and four times seconds) depending on how often the callback reports
+    that something has changed; see update_interval.
+    """
+
+    def __init__(self, callback, seconds=None, trigger_on_start=False, *, adaptive=False,
+                 min_seconds=None, max_seconds=None, fixed_rate=False, jitter=0, cron=None,
+                 skip_if_running=True):
+        assert (seconds is None) != (cron is None), "Either seconds or cron must be given"
+        self.callback = callback
+        self.name = callback.__qualname__
+        self.seconds = seconds
+        self.cron = CronExpression(cron) if cron is not None else None
+        self.trigger_on_start = trigger_on_start
+        self.fixed_rate = fixed_rate
+        self.jitter = jitter
+        self.skip_if_running = skip_if_running
+
+        self.adaptive = adaptive and seconds is not None
+        self.min_seconds = min_seconds if min_seconds is not None else (seconds or 0) / 4
+        self.max_seconds = max_seconds if max_seconds is not None else (seconds or 0) * 4
+        self.interval = seconds
+
+        self.scheduler = None
+        self.due = None
+        self.nominal_due = None
+        self.tasks = set()
+
+        self.polls = 0
+        self.changes = 0
+        self.runs = 0
+        self.skipped = 0
+        self.last_duration = None
+        self.total_duration = 0.0
+        self.max_duration = 0.0
+
+    def first_due(self, now):
+        if self.trigger_on_start:
+            return now
+        return self.next_due(now, now)
+
+    def next_due(self, previous, now):
+        """Returns the loop time of the next run, given when the previous one was due"""
+        if self.cron is not None:
+            wall_now = datetime.datetime.now()
+            return now + (self.cron.next_after(wall_now) - wall_now).total_seconds()
+        elif self.fixed_rate:
+            due = previous + self.interval
+            if due <= now:
+                # don't try to catch up on missed runs
+                due += (math.floor((now - due) / self.interval) + 1) * self.interval
+            return due
+        else:
+            return now + self.interval
+
+    def update_interval(self, result):
+        """Updates the statistics, and the interval if adaptive, from the callback's result
+
+        The callback may return whether anything had changed since the last run, or a
+        PollResult which also gives how long the fetched data may be cached.
+        """
+        if isinstance(result, PollResult):
+            changed, cache_lifetime = result
+        elif isinstance(result, bool):
+            changed, cache_lifetime = result, None
+        else:
+            return
+
+        self.polls += 1
+        if changed:
+            self.changes += 1
+
+        if self.adaptive:
+            # poll more often while the source is changing and back off while it isn't,
+            # but never before the source says its data will have changed
+            interval = self.interval / 2 if changed else self.interval * 1.25
+            if cache_lifetime is not None:
+                interval = max(interval, cache_lifetime)
+            self.interval = min(max(interval, self.min_seconds), self.max_seconds)
+
+    def record_run(self, duration):
+        self.runs += 1
+        self.last_duration = duration
+        self.total_duration += duration
+        self.max_duration = max(self.max_duration, duration)
+
+    @property
+    def hit_rate(self):
+        return self.changes / self.polls if self.polls > 0 else None
+
+    @property
+    def mean_duration(self):
+        return self.total_duration / self.runs if self.runs > 0 else None
+
+    @property
+    def running(self):
+        return len(self.tasks) > 0
+
+    def __repr__(self):
+        return self.name
+
+
+class Scheduler:
+    """Runs jobs from a single timer heap on the event loop"""
+
+    def __init__(self, *, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.jobs = []
+        self._heap = []
+        self._counter = itertools.count()
+        self._handle = None
+
+    def add(self, job):
+        assert job.scheduler is None, "The job is already scheduled"
+        logging.info("Starting %s", job.name)
+        job.scheduler = self
+        self.jobs.append(job)
+        now = self.loop.time()
+        self._push(job, job.first_due(now))
+
+    def remove(self, job):
+        assert job.scheduler is self, "The job is not scheduled"
+        logging.info("Stopping %s", job.name)
+        self.jobs.remove(job)
+        job.scheduler = None
+        job.due = None
+        for task in list(job.tasks):
+            task.cancel()
+        # its heap entry is discarded once it reaches the top
+        self._reschedule()
+
+    def clear(self):
+        for job in list(self.jobs):
+            self.remove(job)
+
+    def reschedule(self, job, seconds):
+        """Moves the next run of job to seconds from now"""
+        assert job.scheduler is self, "The job is not scheduled"
+        self._push(job, self.loop.time() + seconds)
+
+    def _push(self, job, nominal_due):
+        job.nominal_due = nominal_due
+        job.due = nominal_due + random.uniform(0, job.jitter) if job.jitter else nominal_due
+        heapq.heappush(self._heap, (job.due, next(self._counter), job))
+        self._reschedule()
+
+    def _is_stale(self, entry):
+        due, _, job = entry
+        return job.scheduler is not self or job.due != due
+
+    def _reschedule(self):
+        while len(self._heap) > 0 and self._is_stale(self._heap[0]):
+            heapq.heappop(self._heap)
+
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if len(self._heap) > 0:
+            self._handle = self.loop.call_at(self._heap[0][0], self._run_due)
+
+    def _run_due(self):
+        self._handle = None
+        now = self.loop.time()
+        while len(self._heap) > 0 and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            if self._is_stale(entry):
+                continue
+
+            job = entry[2]
+            job.due = None
+            if job.running and job.skip_if_running:
+                job.skipped += 1
+                logging.warning("Skipping %s, previous run still in progress", job.name)
+            else:
+                task = asyncio.async(self._run(job), loop=self.loop)
+                job.tasks.add(task)
+
+            # fixed delay jobs are pushed again once the run has finished
+            if job.fixed_rate or job.cron is not None:
+                try:
+                    self._push(job, job.next_due(job.nominal_due, now))
+                except Exception:
+                    # don't let a broken job stop all the others
+                    logging.exception("Couldn't schedule the next run of %s, removing it",
+                                      job.name)
+                    self.remove(job)
+
+        self._reschedule()
+
+    @asyncio.coroutine
+    def _run(self, job):
+        task = asyncio.Task.current_task(loop=self.loop)
+        start = time.monotonic()
+        try:
+            res = job.callback()
+            if asyncio.iscoroutine(res):
+                res = yield from res
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("Error in %s", job.name)
+        else:
+            job.update_interval(res)
+        finally:
+            job.record_run(time.monotonic() - start)
+            job.tasks.discard(task)
+            if (job.scheduler is self and not job.fixed_rate and job.cron is None
+                    and job.due is None and not job.running):
+                self._push(job, job.next_due(job.nominal_due, self.loop.time()))
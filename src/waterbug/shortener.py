@@ -0,0 +1,172 @@
+#   Waterbug, a modular IRC bot written using Python 3
+#   Copyright (C) 2011  Arvid Fahlström Myrman
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['URLShortener', 'GoogleShortener', 'LocalShortener']
+
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import urllib.parse
+
+from .network import fetch_url
+
+
+class URLShortener:
+    """Memoizing URL shortener
+
+    Short URLs are kept in cache, which is usually a dict in a module's storage, and sync is
+    called after new URLs have been added to it. Lookups are delegated to backend, and if
+    that fails to fallback, with at most max_concurrent lookups running at a time.
+    """
+
+    def __init__(self, cache, backend, fallback=None, sync=None, max_concurrent=None, *,
+                 loop=None):
+        self.cache = cache
+        self.backend = backend
+        self.fallback = fallback
+        self.sync = sync
+        self.loop = loop or asyncio.get_event_loop()
+        self.semaphore = None
+        if max_concurrent is not None:
+            self.semaphore = asyncio.Semaphore(max_concurrent, loop=self.loop)
+        self.pending = {}
+        self.logger = logging.getLogger("shortener")
+
+    @asyncio.coroutine
+    def shorten(self, url):
+        return (yield from self.shorten_many([url]))[url]
+
+    @asyncio.coroutine
+    def shorten_many(self, urls):
+        """Returns a dict of short URLs, looking up all uncached URLs concurrently
+
+        URLs that could not be shortened map to themselves.
+        """
+        missing = {url for url in urls if url not in self.cache}
+        for url in missing:
+            if url not in self.pending:
+                self.pending[url] = asyncio.async(self._lookup(url), loop=self.loop)
+
+        if len(missing) > 0:
+            yield from asyncio.wait([self.pending[url] for url in missing], loop=self.loop)
+            if self.sync is not None:
+                self.sync()
+
+        return {url: self.cache.get(url, url) for url in urls}
+
+    def forget(self, url):
+        self.cache.pop(url, None)
+
+    @asyncio.coroutine
+    def _lookup(self, url):
+        try:
+            if self.semaphore is not None:
+                with (yield from self.semaphore):
+                    yield from self._shorten(url)
+            else:
+                yield from self._shorten(url)
+        finally:
+            del self.pending[url]
+
+    @asyncio.coroutine
+    def _shorten(self, url):
+        for backend in (self.backend, self.fallback):
+            if backend is None:
+                continue
+            try:
+                self.cache[url] = yield from backend.shorten(url)
+                return
+            except Exception:
+                self.logger.exception("Couldn't shorten %s using %s",
+                                      url, type(backend).__name__)
+
+
+class GoogleShortener:
+
+    def __init__(self, key, timeout=5):
+        self.key = key
+        self.timeout = timeout
+
+    @asyncio.coroutine
+    def shorten(self, url):
+        data = yield from fetch_url(
+            "https://www.googleapis.com/urlshortener/v1/url?key={}".format(self.key),
+            method="POST", data=json.dumps({"longUrl": url}),
+            headers={"Content-Type": "application/json"}, timeout=self.timeout)
+        return json.loads(data.decode('utf-8'))['id']
+
+
+class LocalShortener:
+    """Shortens URLs to codes which are redirected by a small built-in HTTP server
+
+    codes maps each code to its URL and should be persistent for the short URLs to keep
+    working; base_url is the public address at which the server can be reached.
+    """
+
+    def __init__(self, base_url, codes, host="0.0.0.0", port=8080, *, loop=None):
+        self.base_url = base_url.rstrip('/')
+        self.codes = codes
+        self.host = host
+        self.port = port
+        self.loop = loop or asyncio.get_event_loop()
+        self.server = None
+        self.logger = logging.getLogger("shortener")
+
+    @asyncio.coroutine
+    def shorten(self, url):
+        return "{}/{}".format(self.base_url, self.add(url))
+
+    def add(self, url):
+        code = base64.urlsafe_b64encode(hashlib.sha1(url.encode('utf-8')).digest()).decode()
+        for length in range(6, len(code)):
+            if self.codes.setdefault(code[:length], url) == url:
+                return code[:length]
+        raise ValueError("Couldn't find a free code for {}".format(url))
+
+    @asyncio.coroutine
+    def start(self):
+        assert self.server is None, "The shortener is already running"
+        self.server = yield from asyncio.start_server(self.handle_request, self.host, self.port,
+                                                      loop=self.loop)
+        self.logger.info("Serving short URLs on %s:%s", self.host, self.port)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+
+    @asyncio.coroutine
+    def handle_request(self, reader, writer):
+        try:
+            request = yield from asyncio.wait_for(reader.readline(), 10)
+            # skip the headers
+            while (yield from asyncio.wait_for(reader.readline(), 10)) not in (b'\r\n', b'\n', b''):
+                pass
+
+            method, path, _version = request.decode('latin-1').split(' ', 2)
+            url = self.codes.get(path.lstrip('/'))
+            if method not in ('GET', 'HEAD') or url is None:
+                writer.write(b"HTTP/1.0 404 Not Found\r\nContent-Length: 0\r\n\r\n")
+            else:
+                location = urllib.parse.quote(url, safe=":/?#[]@!$&'()*+,;=%~")
+                writer.write("HTTP/1.0 301 Moved Permanently\r\nLocation: {}\r\n"
+                             "Content-Length: 0\r\n\r\n".format(location).encode('ascii'))
+        except (asyncio.TimeoutError, ValueError, ConnectionError):
+            pass
+        finally:
+            writer.close()